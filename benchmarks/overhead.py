@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""Orchestration overhead of n3d.
+
+Generates synthetic deploy/stages trees and measures stage catalog scans,
+preloop startup, the parts of apply_stage (spawn, lock, EnvFIFO, write_stage),
+LogWrapper throughput and reload cost. Results are written as JSON, and
+compared with a previous result file with --compare.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+n3d_dir = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                       os.pardir))
+sys.path.insert(0, n3d_dir)
+import n3d
+
+
+def make_tree(work_dir, stages, output_size=0):
+    """deploy/stages with the given number of trivial stages, spread over
+    directories of 100, the first one writing output_size bytes"""
+    stages_dir = os.path.join(work_dir, 'deploy', 'stages')
+    for index in xrange(stages):
+        stage_dir = os.path.join(stages_dir, 'group%03i' % (index / 100))
+        if not os.path.isdir(stage_dir):
+            os.makedirs(stage_dir)
+        stage = os.path.join(stage_dir, '%05i-stage%i.update' % (index,
+                                                                 index))
+        with open(stage, 'w') as f:
+            f.write('#!/bin/sh\n')
+            if index == 0 and output_size:
+                f.write('yes "n3d benchmark output line" 2>/dev/null | '
+                        'head -c %i\n' % output_size)
+            else:
+                f.write('true\n')
+        os.chmod(stage, 0700)
+
+
+def deploy_options(work_dir, *args):
+    options = n3d.option_parser().parse_args(
+        ['--work-dir', work_dir, '--headless'] + list(args))[0]
+    options.targets = []
+    return options
+
+
+def new_deploy(options):
+    deploy = n3d.DeployCmd()
+    deploy.options = options
+    return deploy
+
+
+def timed(func, *args, **kwargs):
+    time_init = time.time()
+    func(*args, **kwargs)
+    return time.time() - time_init
+
+
+def best_of(repeat, func, *args, **kwargs):
+    return min(timed(func, *args, **kwargs) for _ in xrange(repeat))
+
+
+def bench_catalog(work_dir, repeat):
+    options = deploy_options(work_dir)
+    if os.path.exists(options.stages_cache):
+        os.unlink(options.stages_cache)
+    cold = timed(n3d.StageCatalog(options.stages_dir,
+                                  options.stages_cache).scan)
+    warm = best_of(repeat, lambda: n3d.StageCatalog(
+        options.stages_dir, options.stages_cache).scan())
+    uncached = best_of(repeat, lambda: n3d.StageCatalog(
+        options.stages_dir, None).scan())
+    lookup = new_deploy(options)
+    lookup.scan_stages()
+    names = lookup.stage_nums
+    lookups = best_of(repeat, lambda: [lookup.lookup_stage(name)
+                                       for name in names])
+    return dict(scan_cold=cold, scan_warm=warm, scan_uncached=uncached,
+                lookup_all=lookups)
+
+
+def bench_preloop(work_dir, repeat):
+    options = deploy_options(work_dir)
+    return dict(preloop=best_of(repeat,
+                                lambda: new_deploy(options).preloop()))
+
+
+def bench_apply_stage(work_dir, repeat):
+    """apply_stage of a trivial stage, and the parts of it"""
+    options = deploy_options(work_dir, '--output-dir', '',
+                             '--history-file', '')
+    deploy = new_deploy(options)
+    deploy.preloop()
+    stage_path = deploy.stage_path(1, 'update')
+    results = dict()
+    with open(os.devnull, 'w') as devnull:
+        results['spawn_direct'] = best_of(repeat, subprocess.call,
+                                          [stage_path], stdout=devnull)
+    results['run_piped'] = best_of(repeat, deploy.run_piped, 1, 'update')
+    results['lock'] = best_of(repeat, lambda: (
+        deploy.lock_stage('benchmark'), deploy.unlock_stage()))
+    results['env_fifo'] = best_of(repeat, lambda: n3d.EnvFIFO(deploy).close())
+
+    def write_stage():
+        # the journal skips an unchanged position, move it every time
+        deploy.cur_stage = 1 - deploy.cur_stage
+        deploy.write_stage()
+    deploy.cur_stage = 0
+    results['write_stage'] = best_of(repeat, write_stage)
+
+    def apply_stage():
+        deploy.next_stage = 1
+        deploy.apply_stage('update')
+    results['apply_stage'] = best_of(repeat, apply_stage)
+    results['apply_stage_overhead'] = \
+        results['apply_stage'] - results['spawn_direct']
+    return results
+
+
+def bench_log_wrapper(size, chunk_size=1000):
+    chunk = ('n3d benchmark output line\r\n' * (chunk_size / 27 + 1))
+    chunk = chunk[:chunk_size]
+    time_init = time.time()
+    log_wrap = n3d.LogWrapper()
+    for _ in xrange(size / chunk_size):
+        log_wrap.write(chunk)
+    log_wrap.close()
+    run_time = time.time() - time_init
+    return dict(log_wrapper=run_time,
+                log_wrapper_mb_per_s=size / 1048576.0 / run_time)
+
+
+def bench_output_stage(work_dir):
+    options = deploy_options(work_dir, '--output-dir', '',
+                             '--history-file', '')
+    deploy = new_deploy(options)
+    deploy.preloop()
+    stage_path = deploy.stage_path(0, 'update')
+    with open(os.devnull, 'w') as devnull:
+        direct = timed(subprocess.call, [stage_path], stdout=devnull)
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            piped = timed(deploy.run_piped, 0, 'update')
+        finally:
+            sys.stdout = stdout
+    return dict(output_direct=direct, output_run_piped=piped,
+                output_overhead=piped - direct)
+
+
+def bench_reload(work_dir, repeat):
+    """in-process reload, and a process start as paid by --reload-mode
+    exec"""
+    options = deploy_options(work_dir, '--output-dir', '',
+                             '--history-file', '')
+    deploy = new_deploy(options)
+    deploy.preloop()
+    inprocess = best_of(repeat, deploy.reload_inprocess)
+    with open(os.devnull, 'w') as devnull:
+        restart = best_of(repeat, subprocess.call,
+                          [sys.executable, os.path.join(n3d_dir, 'n3d.py'),
+                           '--headless', '--output-dir', '',
+                           '--history-file', ''],
+                          stdin=open(os.devnull), stdout=devnull,
+                          stderr=devnull, cwd=work_dir)
+    return dict(reload_inprocess=inprocess, reload_exec=restart)
+
+
+def run(options):
+    results = dict(python=platform.python_version(),
+                   platform=platform.platform(),
+                   time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   sizes=dict())
+    oldcwd = os.getcwd()
+    n3d.tty_path = 'benchmark'
+    n3d.tty_owner = 'benchmark'
+    for stages in options.sizes:
+        work_dir = tempfile.mkdtemp(prefix='n3d-bench-')
+        try:
+            os.chdir(work_dir)
+            make_tree(work_dir, stages, options.output_size)
+            logging.root.handlers = []
+            logging.basicConfig(filename=os.path.join(work_dir, 'deploy',
+                                                      'deploy_process.log'),
+                                level=logging.DEBUG)
+            size_results = dict()
+            size_results.update(bench_catalog(work_dir, options.repeat))
+            size_results.update(bench_preloop(work_dir, options.repeat))
+            size_results.update(bench_apply_stage(work_dir, options.repeat))
+            if stages == options.sizes[0]:
+                size_results.update(bench_output_stage(work_dir))
+                size_results.update(bench_log_wrapper(options.output_size))
+                size_results.update(bench_reload(work_dir, options.repeat))
+            results['sizes'][str(stages)] = size_results
+            sys.stderr.write('%6i stages: %s\n' % (stages, ', '.join(
+                '%s %.4f' % i for i in sorted(size_results.items()))))
+        finally:
+            os.chdir(oldcwd)
+            shutil.rmtree(work_dir)
+    return results
+
+
+def compare(old, new):
+    for stages in sorted(new['sizes'], key=int):
+        if stages not in old['sizes']:
+            continue
+        print "%s stages:" % stages
+        for name, value in sorted(new['sizes'][stages].items()):
+            old_value = old['sizes'][stages].get(name)
+            if not old_value:
+                continue
+            print "  %-24s %10.4f %10.4f %7.2fx" % (name, old_value, value,
+                                                   value / old_value)
+
+
+def main():
+    optionparser = OptionParser(usage="usage: %prog [options]")
+    optionparser.add_option("--sizes", dest="sizes",
+                            default="10,100,1000,10000",
+                            help="stage counts of the generated trees\
+                            [ default: %default ]")
+    optionparser.add_option("--output-size", dest="output_size", type="int",
+                            default=16 * 1024 * 1024,
+                            help="bytes written by the high output stage\
+                            [ default: %default ]")
+    optionparser.add_option("--repeat", dest="repeat", type="int",
+                            default=5,
+                            help="runs per measure, the best one is kept\
+                            [ default: %default ]")
+    optionparser.add_option("-o", "--output", dest="output",
+                            help="write the JSON results to this file")
+    optionparser.add_option("--compare", dest="compare",
+                            help="JSON results of a previous run to\
+                            compare with")
+    (options, args) = optionparser.parse_args()
+    options.sizes = [int(size) for size in options.sizes.split(',')]
+    results = run(options)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare, 'r') as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
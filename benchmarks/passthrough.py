@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""Overhead of n3d stage output passthrough.
+
+Runs a verbose stage directly, through the line by line pipe loop the
+first --headless runner used, through the chunked LinePrefixer loop and
+under 'n3d --headless', times the pexpect output filters on their own,
+and runs the stage on a pseudo terminal directly and through the
+interactive runner of n3d.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+n3d_dir = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                       os.pardir))
+sys.path.insert(0, n3d_dir)
+import n3d
+import pexpect
+
+LINE = 'gcc -O2 -c src/module.c -o build/module.o'
+
+
+def legacy_filter(stage_name, line):
+    """pexpect output filter of n3d 0.3, prefixes chunks, not lines"""
+    if stage_name is not None:
+        result = stage_name + ' : ' + line
+    else:
+        result = line
+    if line[-1] not in ('\r', '\n'):
+        result += '\r\n'
+    return result
+
+
+def legacy_loop(proc, out):
+    """pipe loop of the first --headless runner: one readline, write and
+    flush per line"""
+    for line in iter(proc.stdout.readline, ''):
+        line = 'stage : ' + line.rstrip('\r\n')
+        out.write(line + '\n')
+        out.flush()
+
+
+def chunked_loop(proc, out):
+    prefixer = n3d.LinePrefixer('stage : ')
+    partline = ''
+    fd = proc.stdout.fileno()
+    for data in iter(lambda: os.read(fd, 65536), ''):
+        cut = data.rfind('\n') + 1
+        if not cut:
+            partline += data
+            continue
+        out.write(prefixer(partline + data[:cut]))
+        out.flush()
+        partline = data[cut:]
+
+
+def bench_filters(size, chunk_size=1000):
+    data = (LINE + '\r\n') * (chunk_size * 64 / len(LINE))
+    chunks = [data[i:i + chunk_size] for i in
+              xrange(0, len(data) - chunk_size, chunk_size)]
+    count = size / chunk_size / len(chunks)
+    time_init = time.time()
+    for _ in xrange(count):
+        for chunk in chunks:
+            legacy_filter('stage', chunk)
+    legacy = time.time() - time_init
+    prefixer = n3d.LinePrefixer('stage : ')
+    time_init = time.time()
+    for _ in xrange(count):
+        for chunk in chunks:
+            prefixer(chunk)
+    return legacy, time.time() - time_init
+
+
+def timed(func, *args, **kwargs):
+    time_init = time.time()
+    func(*args, **kwargs)
+    return time.time() - time_init
+
+
+def bench_stage(size):
+    work_dir = tempfile.mkdtemp(prefix='n3d-bench-')
+    try:
+        stages_dir = os.path.join(work_dir, 'deploy', 'stages')
+        os.makedirs(stages_dir)
+        stage = os.path.join(stages_dir, '01-verbose.update')
+        with open(stage, 'w') as f:
+            f.write('#!/bin/sh\nyes "%s" 2>/dev/null | head -c %i\n'
+                    % (LINE, size))
+        os.chmod(stage, 0700)
+        results = dict()
+        with open(os.devnull, 'w') as devnull:
+            results['direct'] = timed(subprocess.check_call, [stage],
+                                      stdout=devnull)
+            for name, loop in (('legacy_loop', legacy_loop),
+                               ('chunked_loop', chunked_loop)):
+                time_init = time.time()
+                proc = subprocess.Popen([stage], stdout=subprocess.PIPE)
+                loop(proc, devnull)
+                proc.wait()
+                results[name] = time.time() - time_init
+            env = dict(os.environ, ANSI_COLORS_DISABLED='1')
+            results['n3d_headless'] = timed(
+                subprocess.check_call,
+                [sys.executable, os.path.join(n3d_dir, 'n3d.py'),
+                 '--headless', '--run', '--output-dir', '',
+                 '--history-file', '', '--stages-cache', ''],
+                cwd=work_dir, env=env, stdout=devnull,
+                stdin=open(os.devnull))
+    finally:
+        shutil.rmtree(work_dir)
+    return results
+
+
+def read_until(child, marker):
+    """Read the output of child in large chunks until marker shows up,
+    without expect() searching the whole buffer every time"""
+    data = ''
+    while marker not in data:
+        data = data[-len(marker):] + child.read_nonblocking(65536)
+
+
+def bench_interactive(size):
+    work_dir = tempfile.mkdtemp(prefix='n3d-bench-')
+    try:
+        stages_dir = os.path.join(work_dir, 'deploy', 'stages')
+        os.makedirs(stages_dir)
+        stage = os.path.join(stages_dir, '01-verbose.update')
+        with open(stage, 'w') as f:
+            f.write('#!/bin/sh\nyes "%s" 2>/dev/null | head -c %i\n'
+                    'echo done\n' % (LINE, size))
+        os.chmod(stage, 0700)
+        results = dict()
+        time_init = time.time()
+        child = pexpect.spawn(stage, timeout=None)
+        read_until(child, 'done')
+        child.close()
+        results['direct_pty'] = time.time() - time_init
+        env = dict(os.environ, ANSI_COLORS_DISABLED='1')
+        child = pexpect.spawn(
+            sys.executable, [os.path.join(n3d_dir, 'n3d.py'), '--no-check',
+                             '--output-dir', '', '--history-file', '',
+                             '--stages-cache', ''],
+            cwd=work_dir, env=env, timeout=None)
+        read_until(child, '> ')
+        time_init = time.time()
+        child.sendline('do')
+        read_until(child, 'exit status')
+        results['n3d_interactive'] = time.time() - time_init
+        child.sendeof()
+        child.expect(pexpect.EOF)
+        child.close()
+    finally:
+        shutil.rmtree(work_dir)
+    return results
+
+
+def main():
+    optionparser = OptionParser(usage="usage: %prog [options]")
+    optionparser.add_option("-s", "--size", dest="size", type="int",
+                            default=200,
+                            help="MB of stage output [ default: %default ]")
+    (options, args) = optionparser.parse_args()
+    size = options.size * 1024 * 1024
+    legacy, prefixed = bench_filters(size)
+    print "pexpect output filter, %i MB in 1000 byte chunks:" % options.size
+    print "  n3d 0.3 filter (chunk prefix): %7.3fs" % legacy
+    print "  LinePrefixer (line prefix):    %7.3fs" % prefixed
+    results = bench_stage(size)
+    print "verbose stage, %i MB:" % options.size
+    print "  direct:                        %7.3fs" % results['direct']
+    for name in ('legacy_loop', 'chunked_loop', 'n3d_headless'):
+        print "  %-30s %7.3fs (overhead %.3fs)" % (
+            name + ':', results[name], results[name] - results['direct'])
+    results = bench_interactive(size)
+    print "verbose stage on a terminal, %i MB:" % options.size
+    print "  direct_pty:                    %7.3fs" % results['direct_pty']
+    print "  %-30s %7.3fs (overhead %.3fs)" % (
+        'n3d_interactive:', results['n3d_interactive'],
+        results['n3d_interactive'] - results['direct_pty'])
+
+
+if __name__ == '__main__':
+    main()
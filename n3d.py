@@ -2,85 +2,209 @@
 import os
 import sys
 import stat
-import inspect
 import cmd
 import logging
 import threading
 import time
+import math
 import struct
 import fcntl
 import termios
 import signal
-import pexpect
+import select
+import Queue
 import pwd
-import termcolor
-from ConfigParser import ConfigParser, Error as ConfigParserError
 from optparse import OptionParser
 from datetime import datetime
 import errno
+import imp
+import functools
+import collections
+import json
+import marshal
+import contextlib
 
 cmd_args = sys.argv
-cmd_file = inspect.getfile(inspect.currentframe())
+cmd_file = __file__
+if cmd_file.endswith(('.pyc', '.pyo')):
+    cmd_file = cmd_file[:-1]
+cmd_mtime = os.stat(cmd_file).st_mtime
 log = logging.getLogger(__name__)
 
 tty_path = None
 tty_owner = None
+output_lock = threading.Lock()
+
+
+def read_stage_headers(path, limit=20):
+    """Parse '# n3d-key: value' lines from the head of a stage script"""
+    headers = dict()
+    try:
+        with open(path, 'r') as f:
+            for num, line in enumerate(f):
+                if num >= limit:
+                    break
+                line = line.strip()
+                if not line.startswith('#'):
+                    continue
+                key, sep, value = line.lstrip('#!').partition(':')
+                key = key.strip()
+                if sep and key.startswith('n3d-'):
+                    headers[key[4:]] = value.strip()
+    except IOError:
+        pass
+    return headers
+
+
+def json_str(value):
+    """Decoded JSON with utf-8 str instead of unicode strings"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return [json_str(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((json_str(k), json_str(v)) for k, v in value.items())
+    return value
+
+
+class Tracer(object):
+    """Spans of n3d phases and stage runs, appended to path as Chrome
+    trace events. The JSON array is left open, as the format allows, so
+    that a restarted n3d adds to the same trace and a killed one leaves a
+    readable trace. Does nothing without path."""
+
+    def __init__(self, path=None):
+        self.file = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.tids = 0
+        if path:
+            self.file = open(path, 'a')
+            if not os.fstat(self.file.fileno()).st_size:
+                self.file.write('[\n')
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        if self.file is None:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.complete(name, start, **args)
+
+    def complete(self, name, start, **args):
+        """Span from start, a time.time(), until now"""
+        if self.file is not None:
+            self.emit(dict(name=name, ph='X', ts=start * 1e6,
+                           dur=(time.time() - start) * 1e6, args=args))
+
+    def instant(self, name, **args):
+        if self.file is not None:
+            self.emit(dict(name=name, ph='i', s='p', ts=time.time() * 1e6,
+                           args=args))
+
+    def emit(self, event):
+        event.update(cat='n3d', pid=os.getpid(), tid=self.tid())
+        with self.lock:
+            self.file.write(json.dumps(event) + ',\n')
+            self.file.flush()
+
+    def tid(self):
+        """Small id of the current thread, named in the trace on its
+        first event. Not the thread ident, as idents are reused."""
+        tid = getattr(self.local, 'tid', None)
+        if tid is None:
+            with self.lock:
+                self.tids += 1
+                tid = self.local.tid = self.tids
+                self.file.write(json.dumps(dict(
+                    name='thread_name', ph='M', pid=os.getpid(), tid=tid,
+                    args=dict(name=threading.current_thread().name))) +
+                    ',\n')
+        return tid
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+tracer = Tracer()
+
+
+def traced(name):
+    """Method decorator recording a span of name for each call"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 
 class DeployCmd(cmd.Cmd):
 
     names = ['cat', 'continue', 'do ', 'undo', 'retry', 'list', 'exit',
-             'help']
+             'help', 'stats', 'journal', 'check']
 
     def preloop(self):
-        self.stages = dict()
-        self.stage_nums = list()
-        self.stage_aliases = dict()
-        self.next_stage = 0
-        self.cur_stage = None
+        self.read_state()
         self.cur_status = None
-        global tty_path
-        global tty_owner
-        for root, dirs, files in os.walk(self.options.stages_dir):
-            for stage_f_name in files:
-                stage_name, stage_f_ext = os.path.splitext(stage_f_name)
-                stage_action = stage_f_ext[1:]
-                if stage_action in ('update', 'rollback'):
-                    if stage_name not in self.stages:
-                        self.stages[stage_name] = dict()
-                    stage_path = os.path.join(root, stage_f_name)
-                    self.stages[stage_name][stage_action] = stage_path
-                    try:
-                        os.chmod(stage_path, stat.S_IREAD | stat.S_IWRITE |
-                                 stat.S_IEXEC)
-                    except IOError:
-                        pass
-        self.stage_nums = sorted(self.stages.keys())
-        for index, stage_name in enumerate(self.stage_nums):
-            for alias in stage_name.split('-', 1):
-                self.stage_aliases[alias] = index
-        if os.path.exists(self.options.process_file):
-            conf = ConfigParser()
-            try:
-                conf.read(self.options.process_file)
-                cur_stage_name = conf.get('position', 'current')
-                if cur_stage_name in self.stage_nums:
-                    self.cur_stage = self.stage_nums.index(cur_stage_name)
-                    self.next_stage = self.cur_stage + 1
-                prev_tty_path = conf.get('tty', 'path')
-                prev_tty_owner = conf.get('tty', 'owner')
-                if tty_owner != prev_tty_owner:
-                    log.error('n3d deploy process has already started by '
-                              'the user %s on terminal %s'
-                              % (prev_tty_owner, prev_tty_path))
-                    log.error('If you still want to continue as this user,'
-                              'change the TTY OWNER in: %s, by example:\n'
-                              'sed -i "s/%s/%s/" %s'
-                              % (self.options.process_file, prev_tty_owner,
-                                 tty_owner, self.options.process_file))
-                    sys.exit(1)
-            except ConfigParserError:
-                log.warning('Broken deploy_process.ini file')
+        self.p = None
+        self.procs = dict()
+        self.exit_code = 0
+        self.scheduler_events = None
+        self.aborted = threading.Event()
+        self.broadcast = None
+        self.prepared = dict()
+        self.prepare_upcoming = list()
+        self.prepare_lock = threading.Lock()
+        self.run_usage = dict()
+        self.write_lock = threading.Lock()
+        self.output = None
+        self.force = self.options.force
+        session = self.options.session
+        self.fingerprints = JSONStore(session_path(
+            self.options.fingerprints_file, session))
+        self.checks = JSONStore(session_path(self.options.checks_file,
+                                             session))
+        self.env_stage = None
+        self.history = None
+        if self.options.history_file:
+            self.history = StageHistory(
+                session_path(self.options.history_file, session),
+                session_path(self.options.metrics_file, session))
+        self.base_dir = os.getcwd()
+        if self.tty is not None and tty_owner != self.tty[1]:
+            log.error('n3d deploy process has already started by '
+                      'the user %s on terminal %s'
+                      % (self.tty[1], self.tty[0]))
+            log.error('If you still want to continue as this user,'
+                      'change the TTY OWNER in: %s, by example:\n'
+                      'sed -i "s/%s/%s/" %s'
+                      % (self.options.process_file, self.tty[1],
+                         tty_owner, self.options.process_file))
+            sys.exit(1)
+        if self.run_id is None:
+            # runs started within the same second, one after another or
+            # in other sessions, must not share variables or output
+            self.run_id = '%s-%i' % (
+                datetime.now().strftime('%Y%m%d-%H%M%S.%f'), os.getpid())
+        self.env_store = EnvStore(session_path(self.options.env_file,
+                                               session), self.run_id)
+        restored = self.env_store.variables()
+        for key, (value, stage, version) in restored.items():
+            os.environ[key] = value
+        if restored:
+            log.info('Restored %s variables of run %s: %s' % (
+                len(restored), self.run_id, ' '.join(sorted(restored))))
+        if self.options.output_dir:
+            self.output = OutputStore(session_path(self.options.output_dir,
+                                                   session),
+                                      self.run_id, self.options.keep_runs)
         self.update_prompt()
         try:
             import readline
@@ -92,9 +216,137 @@ class DeployCmd(cmd.Cmd):
         else:
             self.do_list('')
 
+    def postloop(self):
+        if self.broadcast is not None:
+            self.broadcast.close()
+            self.broadcast = None
+
+    def start_broadcast(self):
+        """Serve stage output to 'n3d attach' from the first stage run on,
+        in the working directory"""
+        if self.broadcast is None:
+            self.broadcast = OutputBroadcast(session_path(
+                'deploy/deploy.out', self.options.session))
+
+    @traced('read_state')
+    def read_state(self, readonly=False):
+        """Stage catalog and deploy position from the deploy journal, or
+        a deploy_process.ini left by an older n3d, without touching either
+        with readonly"""
+        self.done_stages = set()
+        self.running_stages = set()
+        self.next_stage = 0
+        self.cur_stage = None
+        self.run_id = None
+        self.tty = None
+        self.usages = None
+        self.target_done = dict((t, set()) for t in self.options.targets)
+        self.target_failed = dict((t, set()) for t in self.options.targets)
+        self.work_dir = os.path.abspath(self.options.work_dir)
+        self.stage_lock = FileLock(os.path.join(self.work_dir, session_path(
+            self.options.lock_file, self.options.session)))
+        self.locks_dir = os.path.join(self.work_dir, self.options.locks_dir)
+        self.scan_stages(readonly)
+        self.journal = DeployJournal(session_path(self.options.journal_file,
+                                                  self.options.session),
+                                     self.options.keep_runs)
+        if self.journal.exists():
+            self.read_journal()
+        elif os.path.exists(self.options.process_file):
+            self.read_process_file()
+        # stages left running by an n3d that died are not running anymore
+        if self.running_stages and self.stage_lock.holder() is None:
+            self.running_stages = set()
+
+    @traced('read_journal')
+    def read_journal(self):
+        state = self.journal.state
+        self.run_id = state['run']
+        if state['current'] in self.catalog.index:
+            self.cur_stage = self.catalog.index[state['current']]
+            self.next_stage = self.cur_stage + 1
+        if state['next'] in self.catalog.index:
+            self.next_stage = self.catalog.index[state['next']]
+        self.done_stages = state['done'] & set(self.stages)
+        self.running_stages = state['running'] & set(self.stages)
+        for target, target_state in state['targets'].items():
+            if target in self.target_done:
+                self.target_done[target] = set(target_state['done'])
+                self.target_failed[target] = set(target_state['failed'])
+        if state['tty'] is not None:
+            self.tty = tuple(state['tty'])
+
+    def read_process_file(self):
+        from ConfigParser import ConfigParser, Error as ConfigParserError
+        conf = ConfigParser()
+        try:
+            conf.read(self.options.process_file)
+            if conf.has_option('position', 'current'):
+                cur_stage_name = conf.get('position', 'current')
+                if cur_stage_name in self.catalog.index:
+                    self.cur_stage = self.catalog.index[cur_stage_name]
+                    self.next_stage = self.cur_stage + 1
+            if conf.has_option('position', 'next'):
+                next_stage_name = conf.get('position', 'next')
+                if next_stage_name in self.catalog.index:
+                    self.next_stage = self.catalog.index[next_stage_name]
+            if conf.has_option('run', 'id'):
+                self.run_id = conf.get('run', 'id')
+            if conf.has_section('stages'):
+                self.done_stages = self.read_stage_set(conf, 'done')
+                self.running_stages = self.read_stage_set(conf, 'running')
+            for section in conf.sections():
+                if not section.startswith('target '):
+                    continue
+                target = conf.get(section, 'path')
+                if target in self.target_done:
+                    self.target_done[target] = self.read_stage_set(
+                        conf, 'done', section)
+                    self.target_failed[target] = self.read_stage_set(
+                        conf, 'failed', section)
+            self.tty = (conf.get('tty', 'path'), conf.get('tty', 'owner'))
+        except ConfigParserError:
+            log.warning('Broken deploy_process.ini file')
+
+    @traced('scan_stages')
+    def scan_stages(self, readonly=False):
+        if not isinstance(getattr(self, 'catalog', None), StageCatalog):
+            self.catalog = StageCatalog(
+                self.options.stages_dir,
+                session_path(self.options.stages_cache, self.options.session))
+        self.catalog.scan(readonly)
+        self.stages = self.catalog.stages
+        self.stage_nums = self.catalog.names
+        self.stage_aliases = self.catalog.aliases
+        self.stage_headers = self.catalog.headers
+
+    def read_stage_set(self, conf, option, section='stages'):
+        if not conf.has_option(section, option):
+            return set()
+        return set(name for name in conf.get(section, option).split(',')
+                   if name in self.stages)
+
+    def lookup_stage(self, line):
+        return self.catalog.lookup(line)
+
+    def stage_depends(self, stage):
+        """Stage numbers declared in the '# n3d-depends:' header,
+        None if the stage declares nothing"""
+        headers = self.stage_headers.get(self.stage_nums[stage], {})
+        if 'depends' not in headers:
+            return None
+        depends = set()
+        for dep in headers['depends'].replace(',', ' ').split():
+            dep_num = self.lookup_stage(dep)
+            if dep_num is None:
+                raise ValueError('Stage %s depends on unknown stage %s'
+                                 % (self.stage_name(stage), dep))
+            depends.add(dep_num)
+        return depends
+
     def stage_name(self, stage):
         if stage is not None and stage >= 0 and stage < len(self.stages):
-            return self.stage_nums[stage].split('-', 1)[-1]
+            return self.catalog.short_names[stage]
         else:
             return None
 
@@ -106,34 +358,131 @@ class DeployCmd(cmd.Cmd):
                 readline_colored(stage_name, 'white'))
 
     def update_prompt(self):
-        self.prompt = "stage | cur: %s | next: %s > " % (
+        self.prompt = "stage | cur: %s | next: %s%s > " % (
                       self.stage_colored(self.cur_stage),
-                      self.stage_colored(self.next_stage))
+                      self.stage_colored(self.next_stage),
+                      self.eta_colored())
+
+    def eta(self):
+        """Expected time of the stages left, from their median durations"""
+        if self.history is None or self.next_stage >= len(self.stages):
+            return None
+        left = [name for name in self.stage_nums[self.next_stage:]
+                if name not in self.done_stages]
+        estimates = [self.history.estimate(name) for name in left]
+        known = [e for e in estimates if e is not None]
+        if not known:
+            return None
+        return format_duration(sum(known)), len(left)
+
+    def eta_colored(self):
+        eta = self.eta()
+        if eta is None:
+            return ''
+        return " | eta: %s" % readline_colored(eta[0], 'yellow')
 
     def cmdloop(self, intro=None, options=None):
         self.options = options
         return cmd.Cmd.cmdloop(self, intro)
 
     def sigwinch_passthrough(self, sig, data):
-        if 'TIOCGWINSZ' in dir(termios):
-            TIOCGWINSZ = termios.TIOCGWINSZ
-        else:
-            TIOCGWINSZ = 1074295912
-        s = struct.pack("HHHH", 0, 0, 0, 0)
-        a = struct.unpack('hhhh', fcntl.ioctl(sys.stdout.fileno(),
-                          TIOCGWINSZ, s))
-        self.p.setwinsize(a[0], a[1])
-
-    def pexpect_filter(self, line):
-        stage_name = self.stage_name(self.next_stage)
-        if stage_name is not None:
-            result = stage_name + ' : ' + line
+        rows, columns = terminal_size()
+        self.p.setwinsize(rows, columns)
+        if self.summary is not None:
+            self.summary.columns = columns
+
+    def pexpect_filter(self, data):
+        self.watchdog.touch()
+        if self.broadcast is not None:
+            self.broadcast.output(self.stage_label, data)
+        data = self.prefixer(data)
+        self.logWrap.write(data)
+        if self.summary is not None:
+            return self.summary.feed(data)
+        return data
+
+    @traced('lock_stage')
+    def lock_stage(self, label):
+        if not self.stage_lock.acquire(label):
+            log.error('Stage %s is already running'
+                      % self.stage_lock.holder())
+            return False
+        return True
+
+    @traced('unlock_stage')
+    def unlock_stage(self):
+        self.stage_lock.release()
+
+    @traced('lock_resources')
+    def lock_resources(self, stage, label):
+        """Take the '# n3d-locks:' resource locks of a stage, in name
+        order, waiting while other stages or n3d sessions hold them.
+        None if aborted meanwhile."""
+        headers = self.stage_headers.get(self.stage_nums[stage], {})
+        names = set(headers.get('locks', '').replace(',', ' ').split())
+        locks = list()
+        for name in sorted(names):
+            lock = FileLock(os.path.join(self.locks_dir, name + '.lock'))
+            waiting = False
+            while not lock.acquire(label):
+                if not waiting:
+                    log.info('%s waits for lock %s held by %s'
+                             % (label, name, lock.holder()))
+                    waiting = True
+                if self.aborted.wait(1):
+                    for taken in locks:
+                        taken.release()
+                    return None
+            locks.append(lock)
+        return locks
+
+    def log_start(self, stage, target=None, action='update'):
+        entry = self.journal.record('start', run=self.run_id,
+                                    stage=self.stage_nums[stage],
+                                    action=action, target=target,
+                                    owner=tty_owner)
+        if self.broadcast is not None:
+            self.broadcast.event(entry)
+
+    @traced('log_exit')
+    def log_exit(self, stage, status, run_time, target=None,
+                 action='update'):
+        stage_name = self.stage_name(stage)
+        if action == 'prepare':
+            stage_name += '.prepare'
+        if target is not None:
+            stage_name = '%s@%s' % (stage_name, target)
+        usage = self.run_usage.pop(stage_name, None)
+        entry = self.journal.record('finish', run=self.run_id,
+                                    stage=self.stage_nums[stage],
+                                    action=action, target=target,
+                                    status=status,
+                                    duration=run_time.total_seconds(),
+                                    owner=tty_owner, usage=usage)
+        if self.broadcast is not None:
+            self.broadcast.event(entry)
+        if target is None and self.history is not None:
+            key = self.stage_nums[stage]
+            if action != 'update':
+                key += '.' + action
+            self.history.record(key, self.run_id, run_time.total_seconds(),
+                                status, usage)
+        if (target is None and action == 'update' and usage is not None and
+                self.usages is not None):
+            self.usages[self.stage_nums[stage]] = usage
+        exit_log = "%s exit status: %s, run time: %s" % (
+                   stage_name, status, run_time)
+        if usage is not None:
+            exit_log += ', ' + format_usage(usage)
+        if status is not None and int(status) == 0:
+            log.info(exit_log)
         else:
-            result = line
-        if line[-1] not in ('\r', '\n'):
-            result += '\r\n'
-        return result
+            log.error(exit_log)
+        if action != 'prepare' and status != 0:
+            # sticky: a later success must not hide a failure
+            self.exit_code = 1
 
+    @traced('apply_stage')
     def apply_stage(self, action):
         if self.next_stage == len(self.stages):
             log.error("Finished all stages")
@@ -147,45 +496,636 @@ class DeployCmd(cmd.Cmd):
                 return True
             oldcwd = os.getcwd()
             os.chdir(self.options.work_dir)
-            if os.path.exists('deploy/stage.lock'):
-                with open('deploy/stage.lock', 'r') as f:
-                    run_stage = f.read()
-                    log.error('Stage %s is already running' % run_stage)
+            fingerprint = None
+            if not self.options.targets:
+                cached, fingerprint = self.is_cached(self.next_stage, action)
+                if cached:
+                    os.chdir(oldcwd)
+                    self.cur_status = 0
+                    return True
+            if action == 'update':
+                self.prepare_ahead([n for n in self.stage_nums[
+                    self.next_stage:] if n not in self.done_stages])
+                status = self.wait_prepare(self.next_stage)
+                if status != 0:
+                    # the update never started: stay on this stage, so the
+                    # next do or continue runs its prepare again
+                    log.error('%s not run, its prepare action failed'
+                              % self.stage_name(self.next_stage))
+                    os.chdir(oldcwd)
+                    self.cur_status = status
                     return False
-            f = open('deploy/stage.lock', 'w')
-            f.write('%s on %s' % (self.stage_name(self.next_stage), tty_path))
-            f.close()
+            if not self.lock_stage(self.stage_name(self.next_stage)):
+                os.chdir(oldcwd)
+                self.cur_status = None
+                return False
             time_init = datetime.now()
-            logWrap = LogWrapper()
-            env_fifo = EnvFIFO()
+            self.log_start(self.next_stage, action=action)
+            # shown by control status and n3d status as the scheduler
+            # shows its stages
+            self.running_stages.add(self.stage_nums[self.next_stage])
+            self.write_stage()
+            self.aborted.clear()
+            self.start_broadcast()
+            if action == 'update':
+                self.env_stage = self.stage_nums[self.next_stage]
+            with tracer.span('EnvFIFO'):
+                env_fifo = EnvFIFO(self, self.options.session)
             try:
-                self.p = pexpect.spawn(stage[action], logfile=logWrap,
-                                       timeout=86400)
-                signal.signal(signal.SIGWINCH, self.sigwinch_passthrough)
-                self.p.interact(output_filter=self.pexpect_filter)
-            except OSError as e:
-                if e.errno != errno.EIO:
-                    raise e
-            self.p.close()
-            self.cur_status = self.p.exitstatus
-            env_fifo.close()
-            os.unlink('deploy/stage.lock')
-            os.chdir(oldcwd)
+                if self.options.targets:
+                    self.cur_status = self.run_fanout(self.next_stage, action)
+                else:
+                    self.cur_status = self.run_attempts(
+                        self.next_stage, action,
+                        interactive=not self.options.headless)
+            finally:
+                with tracer.span('EnvFIFO close'):
+                    env_fifo.close()
+                self.env_stage = None
+                self.running_stages.discard(self.stage_nums[self.next_stage])
+                self.unlock_stage()
+                os.chdir(oldcwd)
             time_done = datetime.now()
-            run_time = (time_done - time_init)
-            exit_log = "%s exit status: %s, run time: %s" % (
-                       self.stage_name(self.next_stage),
-                       self.cur_status,
-                       run_time)
-            if self.cur_status is not None and int(self.cur_status) == 0:
-                log.info(exit_log)
-            else:
-                log.error(exit_log)
+            self.log_exit(self.next_stage, self.cur_status,
+                          time_done - time_init, action=action)
+            self.remember(self.next_stage, action, None, fingerprint,
+                          self.cur_status)
             self.do_list('')
             return True
 
+    def run_interactive(self, stage, action):
+        """Run stage action on the terminal of n3d"""
+        import pexpect
+        self.logWrap = LogWrapper(self.open_output(stage, action))
+        self.stage_label = self.stage_name(stage)
+        self.prefixer = LinePrefixer(self.stage_label + ' : ')
+        self.summary = None
+        if self.options.output_mode == 'summary':
+            self.summary = SummaryView(self.options.summary_lines,
+                                       terminal_size()[1])
+        try:
+            with tracer.span('spawn'):
+                self.p = spawn_usage(self.stage_path(stage, action),
+                                     timeout=None)
+            self.watchdog = self.start_watchdog(stage, self.stage_name(stage),
+                                                self.p.pid)
+            signal.signal(signal.SIGWINCH, self.sigwinch_passthrough)
+            self.p.interact(output_filter=self.pexpect_filter)
+        except OSError as e:
+            if e.errno != errno.EIO:
+                raise e
+        # interact returns as soon as the child exits, pass through what
+        # it wrote last
+        try:
+            while True:
+                data = self.p.read_nonblocking(65536, timeout=0)
+                os.write(sys.stdout.fileno(), self.pexpect_filter(data))
+        except (pexpect.EOF, pexpect.TIMEOUT):
+            pass
+        # end a last line left without a newline, or the exit status would
+        # be printed on it
+        data = self.prefixer.finish()
+        if data:
+            self.logWrap.write(data)
+            if self.summary is not None:
+                self.summary.feed(data)
+            else:
+                os.write(sys.stdout.fileno(), data)
+        self.p.close()
+        if self.summary is not None:
+            os.write(sys.stdout.fileno(), self.summary.render())
+        self.logWrap.close()
+        self.add_usage(self.stage_label, self.p.usage)
+        return self.watchdog.stop(self.p.exitstatus)
+
+    def stage_policy(self, stage):
+        """Timeout, idle timeout, retries and first retry delay of a
+        stage, from its '# n3d-timeout:', '# n3d-idle-timeout:',
+        '# n3d-retries:' and '# n3d-retry-delay:' headers or the command
+        line defaults"""
+        headers = self.stage_headers.get(self.stage_nums[stage], {})
+        policy = list()
+        for key, default, parse in (
+                ('timeout', self.options.stage_timeout, parse_duration),
+                ('idle-timeout', self.options.idle_timeout, parse_duration),
+                ('retries', self.options.retries, int),
+                ('retry-delay', self.options.retry_delay, parse_duration)):
+            try:
+                value = parse(headers.get(key, default))
+            except ValueError:
+                log.warning('Stage %s: bad n3d-%s value: %s, using %s'
+                            % (self.stage_name(stage), key, headers[key],
+                               default))
+                value = parse(default)
+            policy.append(max(value, 0))
+        return policy
+
+    def start_watchdog(self, stage, label, pid):
+        timeout, idle_timeout = self.stage_policy(stage)[:2]
+        return Watchdog(label, pid, timeout, idle_timeout)
+
+    def run_attempts(self, stage, action, target=None, interactive=False):
+        """Run stage action, and again after a failure as many times as
+        its retries allow, doubling the delay each time. Stages killed by
+        a signal, or aborted, are not retried."""
+        retries, delay = self.stage_policy(stage)[2:]
+        label = self.stage_name(stage)
+        if target is not None:
+            label += '@' + target
+        locks = self.lock_resources(stage, label)
+        if locks is None:
+            return None
+        attempt = 0
+        try:
+            while True:
+                with tracer.span(label, action=action, attempt=attempt):
+                    if interactive:
+                        status = self.run_interactive(stage, action)
+                    else:
+                        status = self.run_piped(stage, action, target)
+                if (not status or status < 0 or attempt >= retries or
+                        self.aborted.is_set()):
+                    return status
+                attempt += 1
+                log.warning('%s exit status: %s, retry %s of %s in %s'
+                            % (label, status, attempt, retries,
+                               format_duration(delay)))
+                with tracer.span('retry delay'):
+                    self.aborted.wait(delay)
+                delay *= 2
+                if self.aborted.is_set():
+                    return status
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def stage_key(self, stage, action, target=None):
+        key = self.stage_nums[stage]
+        if action != 'update':
+            key += '.' + action
+        if target is not None:
+            key += '@' + target
+        return key
+
+    def open_output(self, stage, action, target=None):
+        if self.output is None:
+            return None
+        return self.output.open_stage(self.stage_key(stage, action, target))
+
+    def fingerprint(self, stage, action, target=None):
+        """Hash of the stage script, its '# n3d-inputs:' files and
+        '# n3d-env:' variables, None if the stage can not be skipped"""
+        headers = self.stage_headers.get(self.stage_nums[stage], {})
+        if (not self.options.incremental or action != 'update' or
+                'inputs' not in headers):
+            return None
+        import glob
+        import hashlib
+        base_dir = target or os.path.abspath(self.options.work_dir)
+        digest = hashlib.sha1()
+        hash_file(digest, self.stage_path(stage, action))
+        for pattern in headers['inputs'].split():
+            paths = sorted(glob.glob(os.path.join(base_dir, pattern)))
+            if not paths:
+                digest.update('missing %s\0' % pattern)
+            for path in paths:
+                for root, dirs, files in walk_inputs(path):
+                    for f_name in files:
+                        f_path = os.path.join(root, f_name)
+                        digest.update(os.path.relpath(f_path, base_dir) +
+                                      '\0')
+                        hash_file(digest, f_path)
+        for name in headers.get('env', '').split():
+            digest.update('%s=%s\0' % (name, os.environ.get(name, '')))
+        return digest.hexdigest()
+
+    @traced('is_cached')
+    def is_cached(self, stage, action, target=None):
+        """Fingerprint of the stage and whether its last successful run
+        had the same one"""
+        fingerprint = self.fingerprint(stage, action, target)
+        if fingerprint is None or self.force:
+            return False, fingerprint
+        key = self.stage_key(stage, action, target)
+        if self.fingerprints.get(key) != fingerprint:
+            return False, fingerprint
+        label = self.stage_name(stage)
+        if target is not None:
+            label += '@' + target
+        log.info('%s is cached, skipped' % label)
+        return True, fingerprint
+
+    @traced('remember')
+    def remember(self, stage, action, target, fingerprint, status):
+        if fingerprint is not None and status == 0:
+            self.fingerprints.set(self.stage_key(stage, action, target),
+                                  fingerprint)
+
+    def stage_path(self, stage, action):
+        return os.path.join(self.base_dir,
+                            self.stages[self.stage_nums[stage]][action])
+
+    def run_piped(self, stage, action, target=None, echo=True):
+        """Run stage action without a terminal, streaming its output
+        line by line prefixed by the stage name, to the terminal too with
+        echo"""
+        import subprocess
+        label = self.stage_name(stage)
+        if action == 'prepare':
+            label += '.prepare'
+        env = None
+        if target is not None:
+            label = '%s@%s' % (label, target)
+            env = dict(os.environ, N3D_TARGET=target,
+                       N3D_WORK_DIR=self.work_dir)
+        prefixer = LinePrefixer(label + ' : ')
+        logWrap = LogWrapper(self.open_output(stage, action, target))
+        with open(os.devnull, 'r') as devnull, tracer.span('spawn'):
+            proc = subprocess.Popen([self.stage_path(stage, action)],
+                                    stdin=devnull, env=env,
+                                    cwd=target or self.work_dir,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    close_fds=True, preexec_fn=os.setpgrp)
+        self.procs[label] = proc
+        watchdog = self.start_watchdog(stage, label, proc.pid)
+        partline = ''
+        fd = proc.stdout.fileno()
+        for data in iter(lambda: os.read(fd, 65536), ''):
+            watchdog.touch()
+            if self.broadcast is not None:
+                self.broadcast.output(label, data)
+            # write whole lines only, so parallel stages never share one
+            cut = data.rfind('\n') + 1
+            if not cut:
+                partline += data
+                continue
+            lines = prefixer(partline + data[:cut])
+            partline = data[cut:]
+            if echo:
+                with output_lock:
+                    sys.stdout.write(lines)
+                    sys.stdout.flush()
+            logWrap.write(lines)
+        if partline:
+            lines = prefixer(partline + '\n')
+            if echo:
+                with output_lock:
+                    sys.stdout.write(lines)
+                    sys.stdout.flush()
+            logWrap.write(lines)
+        proc.stdout.close()
+        logWrap.close()
+        with tracer.span('wait'):
+            status, usage = wait_usage(proc.pid)[1:]
+        del self.procs[label]
+        if status is not None:
+            proc.returncode = exit_status(status)
+        self.add_usage(label, usage)
+        return watchdog.stop(proc.returncode)
+
+    def add_usage(self, label, usage):
+        """Add the resource usage of a stage run to the ones of its
+        earlier attempts, until log_exit takes them"""
+        total = self.run_usage.get(label)
+        if usage is None or total is None:
+            self.run_usage[label] = usage or total
+            return
+        self.run_usage[label] = dict(
+            (key, max(value, usage[key]) if key == 'maxrss' else
+             value + usage[key]) for key, value in total.items())
+
+    def stage_usages(self):
+        """Resource usage of the last update of each stage in this run"""
+        if self.usages is None:
+            usages = dict()
+            for entry in self.journal.last_run(self.run_id):
+                if (entry['event'] == 'finish' and entry.get('usage') and
+                        entry['action'] == 'update' and
+                        entry['target'] is None):
+                    usages[entry['stage']] = entry['usage']
+            self.usages = usages
+        return self.usages
+
+    def run_fanout(self, stage, action):
+        """Run stage action in every target directory, up to
+        --target-jobs at once. Targets that already finished the stage
+        are skipped, unless all of them did."""
+        stage_name = self.stage_nums[stage]
+        targets = self.options.targets
+        if all(stage_name in self.target_done[t] for t in targets):
+            for target in targets:
+                self.target_done[target].discard(stage_name)
+        todo = [t for t in targets if stage_name not in self.target_done[t]]
+        policy = self.options.on_failure
+        if policy == 'canary' and len(todo) > 1:
+            failed = self.run_targets(stage, action, todo[:1], 'stop')
+            if not failed:
+                failed = self.run_targets(stage, action, todo[1:],
+                                          'continue')
+        else:
+            failed = self.run_targets(stage, action, todo, policy)
+        if failed:
+            log.error('%s failed on %s of %s targets: %s'
+                      % (self.stage_name(stage), len(failed), len(targets),
+                         ' '.join(failed)))
+            return 1
+        return 0
+
+    def run_targets(self, stage, action, targets, policy):
+        """Run stage action in targets, return those it failed in"""
+        stage_name = self.stage_nums[stage]
+        todo = Queue.Queue()
+        for target in targets:
+            todo.put(target)
+        failed = list()
+
+        def worker():
+            while not (failed and policy == 'stop'):
+                try:
+                    target = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                cached, fingerprint = self.is_cached(stage, action, target)
+                if cached:
+                    status = 0
+                else:
+                    time_init = datetime.now()
+                    self.log_start(stage, target, action)
+                    try:
+                        status = self.run_attempts(stage, action, target)
+                    except OSError as e:
+                        log.error('%s failed to start on %s: %s'
+                                  % (self.stage_name(stage), target, e))
+                        status = 1
+                    self.log_exit(stage, status, datetime.now() - time_init,
+                                  target, action)
+                    self.remember(stage, action, target, fingerprint, status)
+                if status == 0:
+                    self.target_done[target].add(stage_name)
+                    self.target_failed[target].discard(stage_name)
+                else:
+                    self.target_failed[target].add(stage_name)
+                    failed.append(target)
+                    if policy == 'stop':
+                        self.terminate_targets(stage)
+                self.write_stage()
+
+        workers = [threading.Thread(target=worker) for _ in
+                   range(min(self.options.target_jobs, len(targets)))]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return failed
+
+    def terminate_targets(self, stage):
+        prefix = self.stage_name(stage) + '@'
+        # no poll(): reaping belongs to the worker running the target, it
+        # would lose the exit status and usage of the stage
+        for label, proc in self.procs.items():
+            if label.startswith(prefix):
+                kill_group(proc.pid)
+
+    def stage_worker(self, stage, finished):
+        if not self.options.targets:
+            cached, fingerprint = self.is_cached(stage, 'update')
+            if cached:
+                finished.put((stage, 0))
+                return
+        status = self.wait_prepare(stage)
+        if status != 0:
+            log.error('%s not run, its prepare action failed'
+                      % self.stage_name(stage))
+            finished.put((stage, status))
+            return
+        time_init = datetime.now()
+        self.log_start(stage)
+        try:
+            if self.options.targets:
+                status = self.run_fanout(stage, 'update')
+            else:
+                status = self.run_attempts(stage, 'update')
+        except Exception as e:
+            log.error('%s failed to start: %s' % (self.stage_name(stage), e))
+            status = 1
+        self.log_exit(stage, status, datetime.now() - time_init)
+        if not self.options.targets:
+            self.remember(stage, 'update', None, fingerprint, status)
+        finished.put((stage, status))
+
+    def prepare_ahead(self, upcoming=None):
+        """Start the '.prepare' actions of the next --prepare-ahead stages
+        of upcoming, by name, in the background, up to --prepare-jobs at
+        once. Without upcoming, of the stages given last time."""
+        with self.prepare_lock:
+            if upcoming is not None:
+                self.prepare_upcoming = upcoming[:self.options.prepare_ahead]
+            running = len([p for p in self.prepared.values()
+                           if not p['done'].is_set()])
+            for name in self.prepare_upcoming:
+                if running >= self.options.prepare_jobs:
+                    break
+                if (name in self.prepared or
+                        'prepare' not in self.stages.get(name, {})):
+                    continue
+                self.start_prepare(name)
+                running += 1
+
+    def start_prepare(self, name):
+        prepare = dict(done=threading.Event(), status=None)
+        self.prepared[name] = prepare
+        thread = threading.Thread(target=self.run_prepare,
+                                  args=(name, prepare),
+                                  name='%s.prepare' % name)
+        thread.daemon = True
+        thread.start()
+        return prepare
+
+    def run_prepare(self, name, prepare):
+        stage = self.catalog.index[name]
+        time_init = datetime.now()
+        self.log_start(stage, action='prepare')
+        try:
+            with tracer.span(self.stage_name(stage), action='prepare'):
+                status = self.run_piped(stage, 'prepare', echo=False)
+        except OSError as e:
+            log.error('%s.prepare failed to start: %s'
+                      % (self.stage_name(stage), e))
+            status = 1
+        self.log_exit(stage, status, datetime.now() - time_init,
+                      action='prepare')
+        prepare['status'] = status
+        prepare['done'].set()
+        self.prepare_ahead()
+
+    @traced('wait_prepare')
+    def wait_prepare(self, stage):
+        """Exit status of the '.prepare' action of a stage, 0 if it has
+        none. Started now unless it ran ahead, again if that failed."""
+        name = self.stage_nums[stage]
+        if 'prepare' not in self.stages[name]:
+            return 0
+        with self.prepare_lock:
+            prepare = self.prepared.get(name)
+            if prepare is None or prepare['status'] not in (None, 0):
+                prepare = self.start_prepare(name)
+        if not prepare['done'].is_set():
+            log.info('%s waits for its prepare action'
+                     % self.stage_name(stage))
+            # a timeout keeps the wait interruptible by Ctrl-C
+            while not prepare['done'].wait(1):
+                pass
+        return prepare['status']
+
+    @traced('run_scheduler')
+    def run_scheduler(self):
+        """Run stages from next_stage concurrently, respecting declared
+        dependencies. Stages without '# n3d-depends:' header wait for
+        all preceding stages."""
+        first_stage = self.next_stage
+        pending = [stage for stage in range(first_stage, len(self.stages))
+                   if self.stage_nums[stage] not in self.done_stages]
+        depends = dict()
+        try:
+            for pos, stage in enumerate(pending):
+                declared = self.stage_depends(stage)
+                if declared is None:
+                    depends[stage] = set(pending[:pos])
+                else:
+                    depends[stage] = declared & set(pending)
+        except ValueError as e:
+            log.error(e)
+            self.cur_status = None
+            return
+        if not pending:
+            log.error("Finished all stages")
+            self.cur_status = None
+            return
+        oldcwd = os.getcwd()
+        os.chdir(self.options.work_dir)
+        if not self.lock_stage('continue'):
+            os.chdir(oldcwd)
+            self.cur_status = None
+            return
+        self.aborted.clear()
+        self.start_broadcast()
+        with tracer.span('EnvFIFO'):
+            env_fifo = EnvFIFO(self, self.options.session)
+        finished = Queue.Queue()
+        self.scheduler_events = finished
+        running = set()
+        self.cur_status = 0
+        try:
+            while pending or running:
+                if (self.cur_status == 0 and
+                        not os.environ.get('RELOAD_DEPLOY')):
+                    self.prepare_ahead([self.stage_nums[s] for s in pending])
+                    for stage in list(pending):
+                        if len(running) >= self.options.jobs:
+                            break
+                        if depends[stage] & (set(pending) | running):
+                            continue
+                        pending.remove(stage)
+                        running.add(stage)
+                        self.running_stages.add(self.stage_nums[stage])
+                        worker = threading.Thread(
+                            target=self.stage_worker, args=(stage, finished),
+                            name=self.stage_nums[stage])
+                        worker.daemon = True
+                        worker.start()
+                    self.write_stage()
+                if not running:
+                    break
+                # a timeout keeps the wait interruptible by Ctrl-C, and
+                # a short one never expires under a long stage
+                while True:
+                    try:
+                        stage, status = finished.get(True, 1)
+                        break
+                    except Queue.Empty:
+                        pass
+                if stage is None:
+                    continue
+                running.discard(stage)
+                self.running_stages.discard(self.stage_nums[stage])
+                if status == 0:
+                    self.done_stages.add(self.stage_nums[stage])
+                    self.env_store.snapshot(self.stage_nums[stage])
+                    self.cur_stage = stage
+                elif self.cur_status == 0:
+                    self.cur_status = status
+                self.write_stage()
+            if (pending and self.cur_status == 0 and
+                    not os.environ.get('RELOAD_DEPLOY')):
+                log.error('Unsatisfiable dependencies for stages: %s'
+                          % ', '.join(self.stage_nums[s] for s in pending))
+                self.cur_status = None
+        finally:
+            self.scheduler_events = None
+            with tracer.span('EnvFIFO close'):
+                env_fifo.close()
+            self.unlock_stage()
+            os.chdir(oldcwd)
+        self.next_stage = len(self.stages)
+        for stage in range(first_stage, len(self.stages)):
+            if self.stage_nums[stage] not in self.done_stages:
+                self.next_stage = stage
+                break
+        self.write_stage()
+        self.do_list('')
+        self.reload_deploy()
+
+    def control_status(self):
+        return dict(current=self.cur_stage is not None and
+                    self.stage_nums[self.cur_stage] or None,
+                    next=self.next_stage < len(self.stages) and
+                    self.stage_nums[self.next_stage] or None,
+                    running=sorted(self.running_stages),
+                    done=sorted(self.done_stages),
+                    status=self.cur_status,
+                    jobs=self.options.jobs,
+                    pid=os.getpid())
+
+    def control_abort(self):
+        self.kill_stages()
+        log.error('Aborted by control command')
+        return 'ok'
+
+    def kill_stages(self):
+        """Terminate the process groups of all running stages, without
+        retrying them"""
+        self.aborted.set()
+        pids = [proc.pid for proc in self.procs.values()]
+        if self.p is not None:
+            pids.append(self.p.pid)
+        for pid in pids:
+            kill_group(pid)
+
+    def control_jobs(self, jobs):
+        self.options.jobs = max(jobs, 1)
+        log.info('Parallel jobs: %s' % self.options.jobs)
+        if self.scheduler_events is not None:
+            self.scheduler_events.put((None, None))
+        return 'ok'
+
+    def control_env(self, key, value):
+        """Keep a variable set through the control channel, as set by
+        the stage running, by the run when there are several"""
+        stage = self.env_stage
+        running = list(self.running_stages)
+        if stage is None and len(running) == 1:
+            stage = running[0]
+        self.env_store.publish(key, value, stage)
+
     def do_list(self, line):
         """ List all stages """
+        for list_line in self.list_lines():
+            log.info(list_line)
+
+    def list_lines(self):
+        usages = self.stage_usages()
         for index, stage_name in enumerate(self.stage_nums):
             if index == self.cur_stage:
                 comment = "(current stage)"
@@ -193,64 +1133,173 @@ class DeployCmd(cmd.Cmd):
             elif index == self.next_stage:
                 comment = "(next stage)"
                 stage_marker = '>'
+            elif stage_name in self.running_stages:
+                comment = "(running)"
+                stage_marker = '~'
+            elif stage_name in self.done_stages:
+                comment = "(done)"
+                stage_marker = '+'
             else:
                 comment = ""
                 stage_marker = ' '
-            log.info("%s%2i: %s %s" % (stage_marker, index, stage_name,
-                                       comment))
+            if self.options.targets:
+                comment += self.targets_summary(stage_name)
+            if stage_name in usages:
+                comment += " [%s]" % format_usage(usages[stage_name], True)
+            yield "%s%2i: %s %s" % (stage_marker, index, stage_name, comment)
 
+    def targets_summary(self, stage_name):
+        done = len([t for t in self.options.targets
+                    if stage_name in self.target_done[t]])
+        failed = len([t for t in self.options.targets
+                      if stage_name in self.target_failed[t]])
+        if not done and not failed:
+            return ""
+        summary = " [%s/%s targets" % (done, len(self.options.targets))
+        if failed:
+            summary += ", %s failed" % failed
+        return summary + "]"
+
+    @traced('write_stage')
     def write_stage(self):
-        if self.cur_stage is not None:
-            with open(self.options.process_file, 'w') as f:
-                conf = ConfigParser()
-                conf.add_section('position')
-                conf.set('position', 'current',
-                         self.stage_nums[self.cur_stage])
-                conf.add_section('tty')
-                conf.set('tty', 'path', tty_path)
-                conf.set('tty', 'owner', tty_owner)
-                conf.write(f)
-        elif os.path.exists(self.options.process_file):
+        with self.write_lock:
+            self.write_journal()
+
+    def write_journal(self):
+        targets_state = any(self.target_done.values()) or \
+            any(self.target_failed.values())
+        if (self.cur_stage is not None or self.done_stages or
+                self.running_stages or targets_state):
+            self.journal.update(dict(
+                run=self.run_id,
+                current=self.cur_stage is not None and
+                self.stage_nums[self.cur_stage] or None,
+                next=self.next_stage < len(self.stages) and
+                self.stage_nums[self.next_stage] or None,
+                done=self.done_stages, running=self.running_stages,
+                targets=dict((t, dict(done=sorted(self.target_done[t]),
+                                      failed=sorted(self.target_failed[t])))
+                             for t in self.options.targets),
+                tty=[tty_path, tty_owner]))
+        else:
+            self.journal.reset()
+        if os.path.exists(self.options.process_file):
             os.unlink(self.options.process_file)
 
+    @traced('reload_inprocess')
+    def reload_inprocess(self):
+        """Refresh what a restart would: n3d module if the file changed,
+        envvars file if it changed, and the stage catalog. Keeps the
+        running cmd loop with its queued commands."""
+        global cmd_mtime
+        module_mtime = os.stat(cmd_file).st_mtime
+        if module_mtime != cmd_mtime:
+            state = dict(tty_path=tty_path, tty_owner=tty_owner,
+                         cmd_args=cmd_args, log=log, tracer=tracer)
+            if __name__ == '__main__':
+                module = imp.load_source('n3d', cmd_file)
+            else:
+                module = reload(sys.modules[__name__])
+            for name, value in state.items():
+                setattr(module, name, value)
+            module.cmd_mtime = module_mtime
+            self.__class__ = module.DeployCmd
+            log.info('Reloaded %s' % cmd_file)
+        if os.path.exists(self.options.envvars):
+            envvars_mtime = os.stat(self.options.envvars).st_mtime
+            if envvars_mtime != getattr(self.options, 'envvars_mtime', None):
+                load_envvars(self.options)
+                for line in self.options.envs or []:
+                    set_env(line)
+        next_name = self.stage_nums[self.next_stage] \
+            if self.next_stage < len(self.stages) else None
+        cur_name = self.stage_nums[self.cur_stage] \
+            if self.cur_stage is not None else None
+        self.scan_stages()
+        self.cur_stage = self.catalog.index.get(cur_name)
+        self.next_stage = self.catalog.index.get(next_name, len(self.stages))
+        self.done_stages &= set(self.stage_nums)
+        self.update_prompt()
+
     def reload_deploy(self):
         global cmd_file
         global cmd_args
         if os.environ.get('RELOAD_DEPLOY'):
             del os.environ['RELOAD_DEPLOY']
+            # set through the control channel it is stored too, and would
+            # be restored by every later start of the run
+            if 'RELOAD_DEPLOY' in self.env_store.variables():
+                self.env_store.publish('RELOAD_DEPLOY', None)
+            if self.options.reload_mode == 'inprocess':
+                log.warning('Reloading...')
+                self.reload_inprocess()
+                return
             log.warning('Restarting...')
             run_args = ['python', cmd_file]
             run_args.extend(cmd_args[1:])
             run_string = ' '.join(run_args)
             logging.shutdown()
+            if tracer.file is not None:
+                # the new n3d records the restart span once started
+                os.environ['N3D_TRACE_RESTART'] = repr(time.time())
+                tracer.close()
             os.execlp('bash', 'bash', '-c', run_string)
 
     def do_continue(self, line):
-        """ Run while exit status is good """
+        """ Run while exit status is good, --force runs stages even if
+            their inputs did not change since their last success.
+            Usage: continue [--force] """
         global cmd_args
-        if '-r' not in cmd_args:
+        if line.strip() == '--force':
+            force = self.force
+            self.force = True
+            try:
+                return self.do_continue('')
+            finally:
+                self.force = force
+        if self.options.check and not self.preflight(
+                range(self.next_stage, len(self.stages)), warnings=False):
+            log.error('Pre-flight check failed, fix the stages above or '
+                      'use --no-check')
+            self.cur_status = None
+            self.exit_code = 1
+            return False
+        if self.options.reload_mode == 'exec' and '-r' not in cmd_args:
             cmd_args.append('-r')
         self.cur_status = 0
         while self.cur_status == 0:
-            self.do_do(line)
+            eta = self.eta()
+            if eta is not None:
+                log.info('ETA: %s for %s stages' % eta)
+            if self.options.jobs > 1:
+                self.run_scheduler()
+            else:
+                self.do_do(line)
         self.update_prompt()
         if self.next_stage == len(self.stages):
-            if os.path.exists(self.options.process_file):
-                os.unlink(self.options.process_file)
+            with self.write_lock:
+                self.journal.reset()
             return True
+        self.exit_code = 1
 
     def do_do(self, line):
-        """ Apply next or specified stage.
-            Usage: do [number_or_name_of_stage] """
+        """ Apply next or specified stage, --force runs it even if its
+            inputs did not change since its last success.
+            Usage: do [number_or_name_of_stage] [--force] """
+        args = line.split()
+        if '--force' in args:
+            args.remove('--force')
+            force = self.force
+            self.force = True
+            try:
+                return self.do_do(' '.join(args))
+            finally:
+                self.force = force
         if line != '':
-            if line in self.stage_aliases.keys():
-                stage_num = self.stage_aliases[line]
-            elif line in self.stage_nums:
-                stage_num = self.stage_nums.index(line)
-            else:
+            stage_num = self.lookup_stage(line)
+            if stage_num is None:
                 log.info("Usage: do [number_or_name_of_stage]")
                 return False
-                stage_num = int(line)
             if stage_num in range(0, len(self.stages)):
                 self.next_stage = stage_num
             else:
@@ -259,39 +1308,262 @@ class DeployCmd(cmd.Cmd):
 
         if self.apply_stage('update'):
             self.cur_stage = self.next_stage
+            if self.cur_status == 0:
+                self.done_stages.add(self.stage_nums[self.cur_stage])
+                self.env_store.snapshot(self.stage_nums[self.cur_stage])
+            else:
+                self.done_stages.discard(self.stage_nums[self.cur_stage])
             self.next_stage = self.next_stage + 1
             self.write_stage()
             self.reload_deploy()
 
     def do_cat(self, line):
         """ Print next or specified stage.
-            Usage: cat [number_or_name_of_stage][.rollback]"""
-        cat_stage = None
+            Usage: cat [number_or_name_of_stage][.rollback|.prepare]"""
+        path = self.cat_path(line)
+        if path is not None:
+            with open(path, 'r') as f:
+                print f.readline()
+        return False
+
+    def cat_path(self, line):
+        """Script of the next or specified stage, None if there is none"""
+        cat_stage = self.next_stage
         action = 'update'
         if line != '':
             line_stage, line_ext = os.path.splitext(line)
-            if line_ext == '.rollback':
-                action = 'rollback'
-            if line_stage in self.stage_aliases.keys():
-                stage_num = self.stage_aliases[line_stage]
-            elif line_stage in self.stage_nums:
-                stage_num = self.stage_nums.index(line_stage)
-            else:
-                log.info("Usage: cat [number_or_name_of_stage][.rollback]")
-                return False
-                stage_num = int(line)
+            if line_ext in ('.rollback', '.prepare'):
+                action = line_ext[1:]
+            stage_num = self.lookup_stage(line_stage)
+            if stage_num is None:
+                log.info("Usage: cat [number_or_name_of_stage]"
+                         "[.rollback|.prepare]")
+                return None
             if stage_num in range(0, len(self.stages)):
                 cat_stage = stage_num
             else:
                 log.error('No such stage')
-                return False
+                return None
+        if cat_stage >= len(self.stages):
+            log.error("Finished all stages")
+            return None
         stage = self.stages[self.stage_nums[cat_stage]]
         if not stage.get(action):
             log.error('Stage %s has no %s action' % (
                 self.stage_name(cat_stage), action))
+            return None
+        return stage[action]
+
+    def process_status(self):
+        """Deploy position as a dict, for the status command"""
+        finished = self.next_stage >= len(self.stages)
+        status = dict(run=self.run_id,
+                      current=self.cur_stage is not None and
+                      self.stage_nums[self.cur_stage] or None,
+                      next=not finished and
+                      self.stage_nums[self.next_stage] or None,
+                      stages=len(self.stages),
+                      done=sorted(self.done_stages),
+                      running=sorted(self.running_stages),
+                      finished=finished,
+                      tty=None, lock=None)
+        if self.tty is not None:
+            status['tty'] = dict(path=self.tty[0], owner=self.tty[1])
+        status['lock'] = self.stage_lock.holder()
+        status['usage'] = self.stage_usages()
+        if self.options.targets:
+            status['targets'] = dict(
+                (t, dict(done=sorted(self.target_done[t]),
+                         failed=sorted(self.target_failed[t])))
+                for t in self.options.targets)
+        return status
+
+    def do_log(self, line):
+        """ Print the output of a stage, by default its last attempt
+            in the current run. Without arguments list the stored runs.
+            Usage: log [number_or_name_of_stage][.rollback][@target]
+                       [run] [attempt] [-lines]"""
+        if self.output is None:
+            log.error('Stage output store is disabled')
+            return False
+        runs = self.output.runs()
+        args = line.split()
+        if not args:
+            for run in runs:
+                stages = set(i[0] for i in self.output.read_index(run))
+                log.info('%s%s: %s stages' % (
+                    run, run == self.run_id and ' (current run)' or '',
+                    len(stages)))
+            return False
+        key, _, target = args.pop(0).partition('@')
+        line_stage, line_ext = os.path.splitext(key)
+        stage_num = self.lookup_stage(line_stage)
+        if stage_num is None:
+            log.info("Usage: log [number_or_name_of_stage][.rollback]"
+                     "[@target] [run] [attempt] [-lines]")
+            return False
+        key = self.stage_nums[stage_num] + line_ext
+        if target:
+            key += '@' + os.path.abspath(target)
+        run = self.run_id
+        attempt = None
+        lines = None
+        for arg in args:
+            if arg in runs:
+                run = arg
+            elif arg.startswith('-') and arg[1:].isdigit():
+                lines = int(arg[1:])
+            elif arg.isdigit():
+                attempt = int(arg)
+        blocks = self.output.read(run, key, attempt)
+        if lines is not None:
+            tail = collections.deque(maxlen=lines)
+            for block in blocks:
+                tail.extend(block.splitlines(True))
+            blocks = tail
+        for block in blocks:
+            sys.stdout.write(block)
+        sys.stdout.flush()
+        return False
+
+    def do_check(self, line):
+        """ Check all stage scripts: executable, interpreter found, syntax
+            and update/rollback pairs """
+        self.preflight(range(len(self.stages)))
+        return False
+
+    @traced('preflight')
+    def preflight(self, stages, warnings=True):
+        """Check stages and log their problems, False if there are
+        errors"""
+        time_init = time.time()
+        errors, stage_warnings = self.check_stages(stages)
+        if warnings:
+            for name, problem in stage_warnings:
+                log.warning('%s: %s' % (name, problem))
+        for name, problem in errors:
+            log.error('%s: %s' % (name, problem))
+        if warnings or errors:
+            log.info('%s stages checked in %.1fs: %s errors, %s warnings' % (
+                len(stages), time.time() - time_init, len(errors),
+                len(stage_warnings)))
+        return not errors
+
+    def check_stages(self, stages):
+        """Errors and warnings of stages as sorted (name, problem) lists,
+        scripts checked by --check-jobs threads. Syntax checks passed are
+        kept by stage file identity."""
+        errors = list()
+        warnings = list()
+        todo = Queue.Queue()
+        for stage in stages:
+            name = self.stage_nums[stage]
+            actions = self.stages[name]
+            if 'update' not in actions:
+                errors.append((name, '%s without update'
+                               % ' and '.join(sorted(actions))))
+            elif 'rollback' not in actions:
+                warnings.append((name, 'no rollback'))
+            for action in sorted(actions):
+                todo.put((name, actions[action]))
+        passed = dict()
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    name, path = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                key = self.catalog.files.get(path, {}).get('key')
+                syntax = key is None or self.checks.get(path) != key
+                problems = check_script(path, syntax)
+                with lock:
+                    errors.extend((os.path.basename(path), problem)
+                                  for problem in problems)
+                    if syntax and key is not None and not problems:
+                        passed[path] = key
+
+        workers = [threading.Thread(target=worker) for _ in
+                   range(max(min(self.options.check_jobs, todo.qsize()), 1))]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        for thread in workers:
+            thread.join()
+        if passed:
+            self.checks.update(passed)
+        return sorted(errors), sorted(warnings)
+
+    def do_journal(self, line):
+        """ List the deploy runs in the journal, or the stage runs of one.
+            Usage: journal [run]"""
+        lines = self.journal_lines(line.strip())
+        if lines is None:
+            log.error('No such run in the journal')
+            return False
+        for journal_line in lines:
+            log.info(journal_line)
+        return False
+
+    def journal_lines(self, run=None):
+        """Lines of the journal command, None if run is unknown"""
+        runs = self.journal.runs()
+        lines = list()
+        if not run:
+            for run_id, entries in runs.items():
+                finished = [e for e in entries if e['event'] == 'finish']
+                failed = [e for e in finished if e['status'] != 0]
+                lines.append('%s%s: %s stage runs, %s failed, since %s' % (
+                    run_id, run_id == self.run_id and ' (current run)' or '',
+                    len(finished), len(failed),
+                    format_time(entries[0]['time'])))
+            return lines
+        if run not in runs:
+            return None
+        return [format_entry(entry) for entry in runs[run]]
+
+    def do_env(self, line):
+        """ List the variables published by stages of this run, or as
+            they were after a stage finished.
+            Usage: env [number_or_name_of_stage]"""
+        lines = self.env_lines(line.strip())
+        if lines is None:
             return False
-        with open(stage[action], 'r') as f:
-            print f.readline()
+        for env_line in lines:
+            log.info(env_line)
+        if not lines:
+            log.info('No variables published in run %s' % self.run_id)
+        return False
+
+    def env_lines(self, line=''):
+        """Lines of the env command, None on errors"""
+        if not line:
+            return self.env_store.lines()
+        stage_num = self.lookup_stage(line)
+        if stage_num is None or stage_num >= len(self.stages):
+            log.error('No such stage')
+            return None
+        lines = self.env_store.lines(self.stage_nums[stage_num])
+        if lines is None:
+            log.error('No variables snapshot of %s'
+                      % self.stage_name(stage_num))
+        return lines
+
+    def do_stats(self, line):
+        """ Show run time statistics of stages from previous runs """
+        if self.history is None:
+            log.error('Stage history is disabled')
+            return False
+        log.info("%-24s %5s %6s %10s %10s %10s" % (
+                 'stage', 'runs', 'failed', 'p50', 'p95', 'last'))
+        for name in sorted(self.history.stages):
+            stats = self.history.stats(name)
+            log.info("%-24s %5i %5i%% %10s %10s %10s" % (
+                     name, stats['runs'], stats['failure_rate'] * 100,
+                     format_duration(stats['p50']),
+                     format_duration(stats['p95']),
+                     format_duration(stats['last'])))
         return False
 
     def do_retry(self, line):
@@ -305,6 +1577,11 @@ class DeployCmd(cmd.Cmd):
         if self.cur_stage is not None:
             self.next_stage = self.cur_stage
             self.apply_stage('rollback')
+            self.done_stages.discard(self.stage_nums[self.cur_stage])
+            for key in self.env_store.drop_stage(
+                    self.stage_nums[self.cur_stage]):
+                os.environ.pop(key, None)
+                log.info('Unset ENV variable: %s' % key)
             if self.cur_stage > 0:
                 self.cur_stage = self.cur_stage - 1
             else:
@@ -324,7 +1601,7 @@ class DeployCmd(cmd.Cmd):
         return [a for a in self.names if a.startswith(text)]
 
     def name_completer(self, text, line, *ignored):
-        aliases = [a for a in self.stage_aliases.keys()
+        aliases = [a for a in self.stage_aliases
                    if a.startswith(line)]
         nums = [self.stage_aliases[a] for a in aliases]
         names = dict()
@@ -341,6 +1618,19 @@ class DeployCmd(cmd.Cmd):
     def complete_cat(self, text, line, *ignored):
         return self.name_completer(text, line[4:], *ignored)
 
+    def complete_env(self, text, line, *ignored):
+        return self.name_completer(text, line[4:], *ignored)
+
+    def complete_journal(self, text, line, *ignored):
+        return [run for run in self.journal.runs() if run.startswith(text)]
+
+    def complete_log(self, text, line, *ignored):
+        return self.name_completer(text, line[4:], *ignored)
+
+    def onecmd(self, line):
+        with tracer.span(line.split(' ', 1)[0] or 'emptyline', line=line):
+            return cmd.Cmd.onecmd(self, line)
+
     def emptyline(self):
         """Do nothing on empty input line"""
         pass
@@ -366,28 +1656,1238 @@ class DeployCmd(cmd.Cmd):
         return cmd.Cmd.postcmd(self, stop, line)
 
 
+class StageCatalog(object):
+    """Stage scripts found under stages_dir. Directory listings, file
+    identities and parsed headers are kept in cache_file, so a rescan only
+    lists directories whose mtime changed and only reads stage files whose
+    inode, size or mtime changed. A readonly scan only checks directories
+    and neither fixes stage file modes nor writes the cache. The cache is
+    in marshal format: unlike JSON it loads str, not unicode, and loads
+    fast enough for the cache to beat a full rescan."""
+
+    actions = ('update', 'rollback', 'prepare')
+    mode = stat.S_IREAD | stat.S_IWRITE | stat.S_IEXEC
+
+    def __init__(self, stages_dir, cache_file=None):
+        self.stages_dir = stages_dir
+        self.cache_file = cache_file
+        self.dirs = dict()
+        self.files = dict()
+        self.stages = dict()
+        self.names = list()
+        self.short_names = list()
+        self.index = dict()
+        self.aliases = dict()
+        self.headers = dict()
+        self.load()
+
+    def load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'rb') as f:
+                cache = marshal.load(f)
+            if (cache.get('stages_dir') == self.stages_dir and
+                    cache.get('actions') == self.actions):
+                self.dirs = cache['dirs']
+                self.files = cache['files']
+        except (IOError, ValueError, EOFError, TypeError, KeyError,
+                AttributeError):
+            log.warning('Broken stages cache file: %s' % self.cache_file)
+
+    def save(self):
+        if not self.cache_file:
+            return
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                marshal.dump(dict(stages_dir=self.stages_dir,
+                                  actions=self.actions, dirs=self.dirs,
+                                  files=self.files), f)
+            os.rename(tmp_file, self.cache_file)
+        except (IOError, OSError) as e:
+            log.warning('Can not write stages cache file: %s' % e)
+
+    def list_dir(self, path, mtime):
+        entry = dict(mtime=mtime, dirs=[], files=[])
+        for f_name in sorted(os.listdir(path)):
+            f_path = os.path.join(path, f_name)
+            if os.path.isdir(f_path):
+                if not os.path.islink(f_path):
+                    entry['dirs'].append(f_name)
+            elif os.path.splitext(f_name)[1][1:] in self.actions:
+                entry['files'].append(f_name)
+        return entry
+
+    def scan(self, readonly=False):
+        changed = False
+        dirs = dict()
+        files = dict()
+        todo = [self.stages_dir]
+        while todo:
+            path = todo.pop(0)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                changed = True
+                continue
+            entry = self.dirs.get(path)
+            if entry is None or entry['mtime'] != mtime:
+                entry = self.list_dir(path, mtime)
+                changed = True
+            dirs[path] = entry
+            todo.extend(os.path.join(path, d) for d in entry['dirs'])
+            for f_name in entry['files']:
+                f_path = os.path.join(path, f_name)
+                if readonly:
+                    files[f_path] = self.files.get(f_path, dict())
+                    continue
+                try:
+                    f_stat = os.stat(f_path)
+                except OSError:
+                    changed = True
+                    continue
+                key = [f_stat.st_ino, f_stat.st_size, f_stat.st_mtime]
+                info = self.files.get(f_path)
+                if info is None or info['key'] != key:
+                    info = dict(key=key)
+                    if f_name.endswith('.update'):
+                        info['headers'] = read_stage_headers(f_path)
+                    changed = True
+                files[f_path] = info
+                if stat.S_IMODE(f_stat.st_mode) != self.mode:
+                    try:
+                        os.chmod(f_path, self.mode)
+                    except OSError:
+                        pass
+        changed = changed or len(files) != len(self.files)
+        self.dirs = dirs
+        self.files = files
+        if changed and not readonly:
+            self.save()
+        self.build()
+
+    def build(self):
+        self.stages = dict()
+        self.headers = dict()
+        for f_path, info in self.files.items():
+            stage_name, stage_f_ext = os.path.splitext(
+                os.path.basename(f_path))
+            self.stages.setdefault(stage_name, dict())[stage_f_ext[1:]] = \
+                f_path
+            if 'headers' in info:
+                self.headers[stage_name] = info['headers']
+        self.names = sorted(self.stages.keys())
+        self.short_names = [n.split('-', 1)[-1] for n in self.names]
+        self.index = dict((n, i) for i, n in enumerate(self.names))
+        self.aliases = dict()
+        for index, stage_name in enumerate(self.names):
+            for alias in stage_name.split('-', 1):
+                self.aliases[alias] = index
+
+    def lookup(self, line):
+        """Stage number by alias, full name or list number"""
+        if line in self.aliases:
+            return self.aliases[line]
+        elif line in self.index:
+            return self.index[line]
+        elif line and line.isdigit() and int(line) < len(self.names):
+            return int(line)
+        return None
+
+
+class OutputStore(object):
+    """Stage output of deploy runs. <run>.out gets the raw output blocks
+    appended, <run>.idx one 'stage attempt offset length' line per block,
+    so a stage output is read back without scanning the whole run."""
+
+    def __init__(self, path, run, keep_runs=20):
+        self.path = path
+        self.run = run
+        self.lock = threading.Lock()
+        self.attempts = dict()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.cleanup(keep_runs)
+        for stage, attempt, offset, length in self.read_index(run):
+            self.attempts[stage] = max(attempt, self.attempts.get(stage, 0))
+        self.data = open(self.run_file(run, '.out'), 'ab')
+        self.index = open(self.run_file(run, '.idx'), 'a')
+
+    def run_file(self, run, ext):
+        return os.path.join(self.path, run + ext)
+
+    def runs(self):
+        return sorted(f_name[:-4] for f_name in os.listdir(self.path)
+                      if f_name.endswith('.idx'))
+
+    def cleanup(self, keep_runs):
+        """Compress the data of all runs but the last one, remove runs
+        beyond keep_runs"""
+        import gzip
+        import shutil
+        runs = [run for run in self.runs() if run != self.run]
+        for run in runs[:-keep_runs or None]:
+            for ext in ('.idx', '.out', '.out.gz'):
+                if os.path.exists(self.run_file(run, ext)):
+                    os.unlink(self.run_file(run, ext))
+        for run in runs[-keep_runs:-1]:
+            data_file = self.run_file(run, '.out')
+            if os.path.exists(data_file):
+                with open(data_file, 'rb') as f_in:
+                    f_out = gzip.open(data_file + '.gz.tmp', 'wb')
+                    shutil.copyfileobj(f_in, f_out)
+                    f_out.close()
+                os.rename(data_file + '.gz.tmp', data_file + '.gz')
+                os.unlink(data_file)
+
+    def open_stage(self, stage):
+        """Writer for the next attempt of stage in the current run"""
+        with self.lock:
+            attempt = self.attempts.get(stage, 0) + 1
+            self.attempts[stage] = attempt
+        return functools.partial(self.append, stage, attempt)
+
+    def append(self, stage, attempt, data):
+        with self.lock:
+            self.data.seek(0, os.SEEK_END)
+            offset = self.data.tell()
+            self.data.write(data)
+            self.data.flush()
+            self.index.write('%s\t%s\t%s\t%s\n'
+                             % (stage, attempt, offset, len(data)))
+            self.index.flush()
+
+    def read_index(self, run):
+        index_file = self.run_file(run, '.idx')
+        if not os.path.exists(index_file):
+            return
+        with open(index_file, 'r') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 4:
+                    yield (fields[0], int(fields[1]), int(fields[2]),
+                           int(fields[3]))
+
+    def read(self, run, stage, attempt=None):
+        """Output blocks of stage attempt (the last one by default)"""
+        import gzip
+        import mmap
+        extents = dict()
+        for i_stage, i_attempt, offset, length in self.read_index(run):
+            if i_stage == stage:
+                extents.setdefault(i_attempt, []).append((offset, length))
+        if not extents:
+            return
+        if attempt is None:
+            attempt = max(extents)
+        data_file = self.run_file(run, '.out')
+        if os.path.exists(data_file) and os.path.getsize(data_file):
+            with open(data_file, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                for offset, length in extents.get(attempt, []):
+                    yield data[offset:offset + length]
+                data.close()
+        elif os.path.exists(data_file + '.gz'):
+            f = gzip.open(data_file + '.gz', 'rb')
+            for offset, length in extents.get(attempt, []):
+                f.seek(offset)
+                yield f.read(length)
+            f.close()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class JSONStore(object):
+    """Small dict persisted as a JSON file, rewritten atomically"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = dict()
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.data = json_str(json.load(f))
+            except ValueError:
+                log.warning('Broken file: %s' % path)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.update({key: value})
+
+    def update(self, values):
+        with self.lock:
+            self.data.update(values)
+            if self.path:
+                with open(self.path + '.tmp', 'w') as f:
+                    json.dump(self.data, f)
+                os.rename(self.path + '.tmp', self.path)
+
+
+class EnvStore(JSONStore):
+    """Environment variables published by the stages of a deploy run
+    through the control channel. Every change is kept with a version and
+    the stage that made it, None for the run, and each finished stage
+    with the version it saw, so the variables after any stage can be
+    replayed. The variables of another run are dropped."""
+
+    def __init__(self, path, run):
+        JSONStore.__init__(self, path)
+        if self.data.get('run') != run:
+            self.data = dict(run=run, changes=[], snapshots=dict())
+
+    def version(self):
+        return len(self.data['changes'])
+
+    def variables(self, version=None):
+        """Variables as of version, by default the last one, as a dict
+        of key: (value, stage, version)"""
+        variables = dict()
+        for number, key, value, stage in self.data['changes'][:version]:
+            if value is None:
+                variables.pop(key, None)
+            else:
+                variables[key] = (value, stage, number)
+        return variables
+
+    def publish(self, key, value, stage=None):
+        """Add a change, value None unsets key"""
+        change = [self.version() + 1, key, value, stage]
+        self.update(dict(changes=self.data['changes'] + [change]))
+
+    def drop_stage(self, stage):
+        """Unset the variables last set by stage, return their keys"""
+        keys = sorted(key for key, (value, owner, number) in
+                      self.variables().items() if owner == stage)
+        for key in keys:
+            self.publish(key, None, stage)
+        if stage in self.data['snapshots']:
+            snapshots = dict(self.data['snapshots'])
+            del snapshots[stage]
+            self.update(dict(snapshots=snapshots))
+        return keys
+
+    def snapshot(self, stage):
+        """Remember the version a finished stage saw, once any variable
+        was published"""
+        if self.version():
+            snapshots = dict(self.data['snapshots'])
+            snapshots[stage] = self.version()
+            self.update(dict(snapshots=snapshots))
+
+    def lines(self, stage=None):
+        """Lines of the env command, None if stage has no snapshot"""
+        version = None
+        if stage is not None:
+            version = self.data['snapshots'].get(stage)
+            if version is None:
+                return None
+        variables = self.variables(version)
+        lines = list()
+        for key in sorted(variables):
+            value, owner, number = variables[key]
+            lines.append('%s=%s (version %s, set by %s)' % (
+                key, value, number, owner or 'the run'))
+        return lines
+
+
+# interpreter options that parse a script without running any of it:
+# not perl, whose -c runs BEGIN blocks and use imports
+syntax_checks = {
+    'sh': ['-n'],
+    'bash': ['-n'],
+    'dash': ['-n'],
+    'ksh': ['-n'],
+    'zsh': ['-n'],
+    'ruby': ['-c'],
+    'python': ['-c', 'import sys; compile(open(sys.argv[1]).read(), '
+               'sys.argv[1], "exec")'],
+}
+
+
+def which(program):
+    """Path of an executable found in PATH, None if there is none"""
+    for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        f_path = os.path.join(path, program)
+        if os.path.isfile(f_path) and os.access(f_path, os.X_OK):
+            return f_path
+    return None
+
+
+def check_script(path, syntax=True):
+    """Problems that would make a stage script fail to start: not
+    executable (and not ours for the catalog to fix), no interpreter, and
+    with syntax, a syntax error found by the interpreter of
+    syntax_checks"""
+    import subprocess
+    problems = list()
+    try:
+        with open(path, 'r') as f:
+            shebang = f.readline()
+            if (not os.access(path, os.X_OK) and
+                    os.fstat(f.fileno()).st_uid != os.geteuid()):
+                problems.append('not executable')
+    except IOError as e:
+        return [e.strerror]
+    argv = shebang[2:].split()
+    if not shebang.startswith('#!') or not argv:
+        return problems + ['no #! interpreter line']
+    interpreter = argv[0]
+    if os.path.basename(interpreter) == 'env' and len(argv) > 1:
+        interpreter = which(argv[1])
+        if interpreter is None:
+            return problems + ['interpreter not found in PATH: %s' % argv[1]]
+    elif not os.access(interpreter, os.X_OK):
+        return problems + ['interpreter not found: %s' % interpreter]
+    name = os.path.basename(interpreter).rstrip('0123456789.')
+    if not syntax or name not in syntax_checks:
+        return problems
+    # close_fds costs more than the check itself with a high fd limit,
+    # and the checkers only parse the script
+    with open(os.devnull, 'r') as devnull:
+        proc = subprocess.Popen([interpreter] + syntax_checks[name] + [path],
+                                stdin=devnull, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+    output = proc.communicate()[0].strip().splitlines()
+    if proc.returncode != 0:
+        problems.append('syntax error: %s' % (
+            output and output[-1] or 'exit status %s' % proc.returncode))
+    return problems
+
+
+def session_path(path, session):
+    """path of a file of the named n3d session, the name inserted before
+    its extension. An empty path, a disabled file, stays empty."""
+    if not session or not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return '%s-%s%s' % (root, session, ext)
+
+
+class FileLock(object):
+    """Exclusive flock of a file, released by the kernel when its holder
+    exits, however it does. The holder writes its label, TTY, PID and host
+    in the file and empties it on release, so a lock left by a crashed
+    holder is told apart and taken over."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self, label):
+        """True if the lock is taken, False if another holder has it"""
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        stale = self.read(fd)
+        if stale is not None:
+            log.warning('Taking over lock %s left by %s'
+                        % (self.path, self.describe(stale)))
+        os.ftruncate(fd, 0)
+        os.write(fd, json.dumps(dict(label=label, tty=tty_path,
+                                     pid=os.getpid(),
+                                     host=os.uname()[1],
+                                     time=time.time())))
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is None:
+            return
+        os.ftruncate(self.fd, 0)
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def read(self, fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = os.read(fd, 4096)
+        os.lseek(fd, 0, os.SEEK_SET)
+        if not data.strip():
+            return None
+        try:
+            return json_str(json.loads(data))
+        except ValueError:
+            # written by an older n3d
+            return dict(label=data.strip())
+
+    @staticmethod
+    def describe(holder):
+        text = holder['label']
+        if holder.get('tty'):
+            text += ' on %s' % holder['tty']
+        if 'pid' in holder:
+            text += ' (pid %s on %s)' % (holder['pid'], holder['host'])
+        return text
+
+    def alive(self, holder):
+        if 'pid' not in holder or holder['host'] != os.uname()[1]:
+            return True
+        try:
+            os.kill(holder['pid'], 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        return True
+
+    def holder(self):
+        """Who holds the lock, None if nobody alive does"""
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            holder = self.read(fd)
+        finally:
+            os.close(fd)
+        if holder is None or not self.alive(holder):
+            return None
+        return self.describe(holder)
+
+
+def reverse_lines(f, block_size=65536):
+    """Lines of a file from the last one back, without their newline"""
+    f.seek(0, os.SEEK_END)
+    pos = f.tell()
+    rest = ''
+    while pos > 0:
+        size = min(block_size, pos)
+        pos -= size
+        f.seek(pos)
+        lines = (f.read(size) + rest).split('\n')
+        rest = lines.pop(0)
+        for line in reversed(lines):
+            yield line
+    yield rest
+
+
+def fsync_dir(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class DeployJournal(object):
+    """Append-only, fsync'd journal of the deploy: 'start' and 'finish'
+    entries of stage runs, and 'state' entries with what changed in the
+    deploy position since the last 'snapshot' entry. The position is
+    rebuilt from the entries after the last snapshot, read from the end
+    of the file. Past compact_entries of them, the file is rewritten
+    atomically with the stage runs of the last keep_runs deploy runs and
+    one snapshot."""
+
+    compact_entries = 1000
+    sets = ('done', 'running')
+
+    def __init__(self, path, keep_runs=20):
+        self.path = path
+        self.keep_runs = keep_runs
+        self.lock = threading.Lock()
+        self.fd = None
+        self.state = self.empty_state()
+        self.entries = 0
+        self.load()
+
+    @staticmethod
+    def empty_state():
+        return dict(run=None, current=None, next=None, done=set(),
+                    running=set(), targets=dict(), tty=None)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        if not self.exists():
+            return
+        entries = list()
+        with open(self.path, 'r') as f:
+            for line in reverse_lines(f):
+                entry = self.parse(line)
+                if entry is None or entry['event'] not in ('state',
+                                                           'snapshot'):
+                    continue
+                entries.append(entry)
+                if entry['event'] == 'snapshot':
+                    break
+        self.entries = len(entries)
+        for entry in reversed(entries):
+            self.apply(entry)
+
+    def parse(self, line):
+        if not line.strip():
+            return None
+        try:
+            return json_str(json.loads(line))
+        except ValueError:
+            log.warning('Broken deploy journal entry: %s' % line[:80])
+            return None
+
+    def read(self):
+        """All entries, oldest first"""
+        if not self.exists():
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                entry = self.parse(line)
+                if entry is not None:
+                    yield entry
+
+    def runs(self):
+        """Stage 'start' and 'finish' entries by deploy run, in order"""
+        runs = collections.OrderedDict()
+        for entry in self.read():
+            if entry['event'] in ('start', 'finish'):
+                runs.setdefault(entry['run'], []).append(entry)
+        return runs
+
+    def last_run(self, run):
+        """Stage 'start' and 'finish' entries of run, the last one
+        journaled, in order. Only its entries are read, from the end of
+        the file."""
+        entries = list()
+        if run is None or not self.exists():
+            return entries
+        with open(self.path, 'r') as f:
+            for line in reverse_lines(f):
+                entry = self.parse(line)
+                if entry is None or entry['event'] not in ('start',
+                                                           'finish'):
+                    continue
+                if entry['run'] != run:
+                    break
+                entries.append(entry)
+        entries.reverse()
+        return entries
+
+    def delta(self, state):
+        entry = dict(event='state', set=dict(), targets=dict(), add=dict(),
+                     remove=dict())
+        for key, value in state.items():
+            old = self.state[key]
+            if key in self.sets:
+                value = set(value)
+                if value - old:
+                    entry['add'][key] = sorted(value - old)
+                if old - value:
+                    entry['remove'][key] = sorted(old - value)
+            elif key == 'targets':
+                for target, target_state in value.items():
+                    if old.get(target) != target_state:
+                        entry['targets'][target] = target_state
+            elif value != old:
+                entry['set'][key] = value
+        for key in entry.keys():
+            if not entry[key]:
+                del entry[key]
+        return entry
+
+    def apply(self, entry):
+        if entry['event'] == 'snapshot':
+            self.state = self.empty_state()
+            entry = self.delta(entry['state'])
+        for key, value in entry.get('set', {}).items():
+            self.state[key] = value
+        self.state['targets'].update(entry.get('targets', {}))
+        for key, names in entry.get('add', {}).items():
+            self.state[key].update(names)
+        for key, names in entry.get('remove', {}).items():
+            self.state[key].difference_update(names)
+
+    def snapshot(self):
+        state = dict(self.state)
+        for key in self.sets:
+            state[key] = sorted(state[key])
+        return dict(event='snapshot', state=state, time=time.time())
+
+    def update(self, state):
+        """Journal what changed in the deploy position"""
+        entry = self.delta(state)
+        if entry.keys() == ['event']:
+            return
+        self.apply(entry)
+        if self.entries >= self.compact_entries:
+            self.compact()
+        else:
+            self.append(entry)
+            self.entries += 1
+
+    def reset(self):
+        """Journal the end of a deploy run, the next one starts anew"""
+        if self.state != self.empty_state():
+            self.state = self.empty_state()
+            self.append(self.snapshot())
+            self.entries = 1
+
+    def record(self, event, **fields):
+        """Journal a stage 'start' or 'finish', return its entry"""
+        entry = dict(fields, event=event)
+        self.append(entry)
+        return entry
+
+    def append(self, entry):
+        entry.setdefault('time', time.time())
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        with self.lock:
+            if self.fd is None:
+                torn = False
+                if self.exists() and os.path.getsize(self.path):
+                    with open(self.path, 'rb') as f:
+                        f.seek(-1, os.SEEK_END)
+                        torn = f.read(1) != '\n'
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND |
+                                  os.O_CREAT, 0644)
+                if torn:
+                    # keep the line torn by a crash apart from the next one
+                    os.write(self.fd, '\n')
+            os.write(self.fd, line)
+            os.fsync(self.fd)
+
+    def compact(self):
+        with self.lock:
+            runs = self.runs()
+            keep = set(runs.keys()[-self.keep_runs:])
+            tmp_file = self.path + '.tmp'
+            with open(tmp_file, 'w') as f:
+                for entry in self.read():
+                    if (entry['event'] in ('start', 'finish') and
+                            entry['run'] in keep):
+                        f.write(json.dumps(entry, sort_keys=True) + '\n')
+                f.write(json.dumps(self.snapshot(), sort_keys=True) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_file, self.path)
+            fsync_dir(self.path)
+            self.close()
+            self.entries = 1
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def hash_file(digest, path):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), ''):
+            digest.update(block)
+
+
+def walk_inputs(path):
+    """os.walk of a directory, a single step for a file"""
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            yield root, dirs, sorted(files)
+    else:
+        yield os.path.dirname(path), [], [os.path.basename(path)]
+
+
+class StageHistory(object):
+    """Run times of stages across deploy runs, one JSON record per line
+    in path. Optionally exported as a Prometheus text file."""
+
+    limit = 100
+
+    def __init__(self, path, metrics_file=None):
+        self.path = path
+        self.metrics_file = metrics_file
+        self.lock = threading.Lock()
+        self.stages = dict()
+        lines = 0
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        record = json_str(json.loads(line))
+                    except ValueError:
+                        continue
+                    self.add(record)
+        if lines > 2 * self.limit * max(len(self.stages), 1):
+            self.compact()
+
+    def add(self, record):
+        records = self.stages.setdefault(record['stage'], [])
+        records.append(record)
+        del records[:-self.limit]
+
+    def compact(self):
+        records = sorted((r for rs in self.stages.values() for r in rs),
+                         key=lambda r: r['time'])
+        with open(self.path + '.tmp', 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        os.rename(self.path + '.tmp', self.path)
+
+    def record(self, stage, run, duration, status, usage=None):
+        record = dict(stage=stage, run=run, duration=duration,
+                      status=status, time=time.time())
+        if usage is not None:
+            record['usage'] = usage
+        with self.lock:
+            self.add(record)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            if self.metrics_file:
+                self.export()
+
+    def stats(self, stage):
+        records = self.stages.get(stage, [])
+        if not records:
+            return None
+        durations = sorted(r['duration'] for r in records)
+        failed = len([r for r in records if r['status'] != 0])
+        return dict(runs=len(records),
+                    failures=failed,
+                    failure_rate=float(failed) / len(records),
+                    p50=percentile(durations, 50),
+                    p95=percentile(durations, 95),
+                    last=records[-1]['duration'],
+                    last_status=records[-1]['status'],
+                    last_usage=records[-1].get('usage'))
+
+    def estimate(self, stage):
+        durations = sorted(r['duration'] for r in self.stages.get(stage, [])
+                           if r['status'] == 0)
+        if not durations:
+            return None
+        return percentile(durations, 50)
+
+    def export(self):
+        metrics = [
+            ('n3d_stage_last_duration_seconds', 'last', 'Last run time'),
+            ('n3d_stage_p50_duration_seconds', 'p50', 'Median run time'),
+            ('n3d_stage_p95_duration_seconds', 'p95',
+             '95th percentile run time'),
+            ('n3d_stage_runs', 'runs', 'Runs kept in the history'),
+            ('n3d_stage_failure_ratio', 'failure_rate',
+             'Part of the kept runs with non-zero exit status'),
+            ('n3d_stage_last_status', 'last_status', 'Last exit status'),
+            ('n3d_stage_last_cpu_seconds', 'cpu', 'Last user and system CPU'
+             ' time'),
+            ('n3d_stage_last_max_rss_bytes', 'maxrss', 'Last maximum resident'
+             ' set size'),
+            ('n3d_stage_last_read_blocks', 'inblock', 'Last block input'
+             ' operations'),
+            ('n3d_stage_last_write_blocks', 'oublock', 'Last block output'
+             ' operations'),
+        ]
+        stats = dict((stage, self.stats(stage)) for stage in self.stages)
+        for stage_stats in stats.values():
+            usage = stage_stats['last_usage'] or dict()
+            stage_stats.update((key, usage.get(key)) for key in
+                               ('maxrss', 'inblock', 'oublock'))
+            stage_stats['cpu'] = (usage['user'] + usage['sys'] if usage
+                                  else None)
+        tmp_file = self.metrics_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            for metric, key, doc in metrics:
+                f.write('# HELP %s %s of the n3d stage\n' % (metric, doc))
+                f.write('# TYPE %s gauge\n' % metric)
+                for stage in sorted(stats):
+                    value = stats[stage][key]
+                    if value is None:
+                        value = 'NaN'
+                    f.write('%s{stage="%s"} %s\n' % (metric, stage, value))
+        os.rename(tmp_file, self.metrics_file)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return "%i:%02i:%04.1f" % (hours, minutes, seconds)
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def format_entry(entry):
+    """One line of a journal 'start' or 'finish' entry"""
+    key = entry['stage']
+    if entry['action'] != 'update':
+        key += '.' + entry['action']
+    if entry['target'] is not None:
+        key += '@' + entry['target']
+    if entry['event'] == 'start':
+        return '%s start  %s (%s)' % (format_time(entry['time']), key,
+                                      entry['owner'])
+    line = '%s finish %s exit status: %s, run time: %s' % (
+        format_time(entry['time']), key, entry['status'],
+        format_duration(entry['duration']))
+    if entry.get('usage'):
+        line += ', ' + format_usage(entry['usage'])
+    return line
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    return '%.1f%s' % (size, unit)
+
+
+def format_usage(usage, short=False):
+    """CPU, memory, block I/O and context switches of a stage run"""
+    line = 'cpu: %.2fs user %.2fs sys, max rss: %s' % (
+        usage['user'], usage['sys'], format_size(usage['maxrss']))
+    if short:
+        return line
+    return line + ', blocks: %i in %i out, switches: %i/%i' % (
+        usage['inblock'], usage['oublock'], usage['nvcsw'],
+        usage['nivcsw'])
+
+
+def parse_duration(value):
+    """Seconds of a duration like 90, 1.5s, 10m, 2h or 1h30m"""
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds = 0
+    number = ''
+    units = dict(s=1, m=60, h=3600, d=86400)
+    for char in value:
+        if char in units and number:
+            seconds += float(number) * units[char]
+            number = ''
+        elif char.isdigit() or char == '.':
+            number += char
+        else:
+            raise ValueError('Bad duration: %s' % value)
+    if number or not value:
+        raise ValueError('Bad duration: %s' % value)
+    return seconds
+
+
+def kill_group(pid, sig=signal.SIGTERM):
+    """Signal the process group led by pid, if it still exists"""
+    try:
+        os.killpg(pid, sig)
+    except OSError:
+        pass
+
+
+def wait_usage(pid, options=0):
+    """os.wait4 retried on EINTR. The resource usage, as a dict, is the
+    one of the child and of the descendants it waited for. Status and
+    usage are None if the child was already reaped elsewhere."""
+    while True:
+        try:
+            pid, status, rusage = os.wait4(pid, options)
+            break
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                log.warning('Process %s was reaped elsewhere, its exit '
+                            'status is lost' % pid)
+                return pid, None, None
+            if e.errno != errno.EINTR:
+                raise
+    if not pid:
+        return pid, status, None
+    # ru_maxrss is in kilobytes on Linux
+    return pid, status, dict(user=rusage.ru_utime, sys=rusage.ru_stime,
+                             maxrss=rusage.ru_maxrss * 1024,
+                             inblock=rusage.ru_inblock,
+                             oublock=rusage.ru_oublock,
+                             nvcsw=rusage.ru_nvcsw, nivcsw=rusage.ru_nivcsw)
+
+
+def exit_status(status):
+    """Exit status of a wait status, as Popen.returncode"""
+    if status is None:
+        return None
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def spawn_usage(command, **kwargs):
+    """pexpect.spawn keeping the resource usage of the child, as
+    wait_usage, in its usage attribute once reaped"""
+    import pexpect
+
+    class UsageSpawn(pexpect.spawn):
+        usage = None
+
+        def isalive(self):
+            if self.terminated:
+                return False
+            pid, status, usage = wait_usage(
+                self.pid, 0 if self.flag_eof else os.WNOHANG)
+            if not pid:
+                return True
+            self.status = status
+            self.exitstatus = self.signalstatus = None
+            if status is not None and os.WIFSIGNALED(status):
+                self.signalstatus = os.WTERMSIG(status)
+            elif status is not None:
+                self.exitstatus = os.WEXITSTATUS(status)
+            self.usage = usage
+            self.terminated = True
+            return False
+    return UsageSpawn(command, **kwargs)
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values"""
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class LinePrefixer(object):
+    """Prefix every line of a chunked stream"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.newline = '\n' + prefix
+        self.line_start = True
+
+    def __call__(self, data):
+        if not data:
+            return data
+        result = data.replace('\n', self.newline)
+        if self.line_start:
+            result = self.prefix + result
+        self.line_start = data[-1] == '\n'
+        if self.line_start:
+            return result[:-len(self.prefix)]
+        return result
+
+    def finish(self):
+        """End a last line left without a newline, return what to write
+        for it"""
+        if self.line_start:
+            return ''
+        self.line_start = True
+        return '\n'
+
+
+class SummaryView(object):
+    """Throttled view of the last lines of a stream, redrawn in place
+    at most every interval seconds"""
+
+    def __init__(self, lines=10, columns=80, interval=0.2):
+        self.lines = lines
+        self.columns = columns
+        self.interval = interval
+        self.tail = ''
+        self.total = 0
+        self.drawn = 0
+        self.last_draw = 0
+
+    def feed(self, data):
+        self.total += len(data)
+        self.tail = (self.tail + data)[-self.lines * self.columns * 2:]
+        if time.time() - self.last_draw < self.interval:
+            return ''
+        return self.render()
+
+    def render(self):
+        self.last_draw = time.time()
+        lines = [line.rsplit('\r', 1)[-1][:self.columns - 1]
+                 for line in self.tail.splitlines()[-self.lines:]]
+        lines.append('... %i KB of output' % (self.total / 1024))
+        view = ''
+        if self.drawn:
+            view = '\033[%iF' % self.drawn
+        view += '\033[J' + ''.join(line + '\r\n' for line in lines)
+        self.drawn = len(lines)
+        return view
+
+
+def terminal_size():
+    """Rows and columns of the terminal on stdout"""
+    if 'TIOCGWINSZ' in dir(termios):
+        TIOCGWINSZ = termios.TIOCGWINSZ
+    else:
+        TIOCGWINSZ = 1074295912
+    s = struct.pack("HHHH", 0, 0, 0, 0)
+    try:
+        return struct.unpack('hhhh', fcntl.ioctl(sys.stdout.fileno(),
+                             TIOCGWINSZ, s))[:2]
+    except IOError:
+        return 24, 80
+
+
+class Watchdog(threading.Thread):
+    """Kills the process group of a stage running longer than timeout
+    seconds, or silent for idle_timeout seconds. Only started if one of
+    them is set."""
+
+    status = 124
+    grace = 10
+
+    def __init__(self, label, pid, timeout=0, idle_timeout=0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.label = label
+        self.pid = pid
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.time_init = self.active = time.time()
+        self.reason = None
+        self.done = threading.Event()
+        if timeout or idle_timeout:
+            self.start()
+
+    def touch(self):
+        self.active = time.time()
+
+    def deadline(self):
+        deadlines = list()
+        if self.timeout:
+            deadlines.append((self.time_init + self.timeout,
+                              'ran longer than %s'
+                              % format_duration(self.timeout)))
+        if self.idle_timeout:
+            deadlines.append((self.active + self.idle_timeout,
+                              'no output for %s'
+                              % format_duration(self.idle_timeout)))
+        return min(deadlines)
+
+    def run(self):
+        while not self.done.is_set():
+            deadline, reason = self.deadline()
+            if time.time() >= deadline:
+                self.reason = reason
+                log.error('%s killed: %s' % (self.label, reason))
+                kill_group(self.pid)
+                if not self.done.wait(self.grace):
+                    kill_group(self.pid, signal.SIGKILL)
+                return
+            self.done.wait(min(deadline - time.time(), 1))
+
+    def stop(self, status):
+        """Stage exit status, Watchdog.status if it was killed"""
+        self.done.set()
+        if self.reason is not None:
+            return self.status
+        return status
+
+
 class LogWrapper():
 
-    def __init__(self):
-        """Setup the file-like object with a logger and a loglevel
+    def __init__(self, output=None, max_chunks=1024, batch_size=256):
+        """Setup the file-like object with a logger and a loglevel.
+        Lines are assembled and logged by a background thread, write
+        blocks only while max_chunks chunks are waiting for it. Each
+        batch of raw chunks is also passed to output, if given.
         """
+        self.output = output
         self.logger = logging.getLogger('LogWrapper')
         self.level = logging.DEBUG
-        self.partline = ''
+        self.partline = bytearray()
+        self.cr_pending = False
+        self.batch_size = batch_size
+        self.chunks = Queue.Queue(max_chunks)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
 
     def write(self, lines):
-        for line in lines.splitlines(True):
-            self.partline += line
-            if self.partline[-1] == '\n':
-                self.logger.log(self.level, self.partline.strip())
-            if self.partline[-1] in ('\r', '\n'):
-                self.lastline = self.partline
-                self.partline = ''
-        self.logger.log(self.level, self.lastline.strip())
+        if isinstance(lines, unicode):
+            lines = lines.encode('utf-8')
+        if lines:
+            self.chunks.put(lines)
 
     def flush(self):
         pass
 
+    def close(self):
+        self.chunks.put(None)
+        self.thread.join()
+
+    def feed(self, data, lines):
+        for piece in data.splitlines(True):
+            if self.cr_pending:
+                self.cr_pending = False
+                if piece == '\n':
+                    lines.append(str(self.partline))
+                    del self.partline[:]
+                    continue
+                # carriage return without newline: the terminal
+                # overwrites the line, so does the log
+                del self.partline[:]
+            if piece[-1] == '\n':
+                self.partline.extend(piece)
+                lines.append(str(self.partline))
+                del self.partline[:]
+            elif piece[-1] == '\r':
+                self.partline.extend(piece[:-1])
+                self.cr_pending = True
+            else:
+                self.partline.extend(piece)
+
+    def run(self):
+        done = False
+        while not done:
+            batch = [self.chunks.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.chunks.get_nowait())
+                except Queue.Empty:
+                    break
+            if batch[-1] is None:
+                done = True
+                batch.pop()
+            if self.output is not None and batch:
+                self.output(''.join(batch))
+            lines = list()
+            for chunk in batch:
+                self.feed(chunk, lines)
+            if done and self.partline:
+                lines.append(str(self.partline))
+            self.emit([line.strip() for line in lines])
+
+    def emit(self, lines):
+        """Log lines as records of one timestamp. Stream handlers get the
+        formatted lines in a single write and flush."""
+        if not lines or not self.logger.isEnabledFor(self.level):
+            return
+        record = self.logger.makeRecord(self.logger.name, self.level,
+                                        '(stage)', 0, '\0', None, None)
+        logger = self.logger
+        while logger:
+            for handler in logger.handlers:
+                if record.levelno < handler.level:
+                    continue
+                if (isinstance(handler, logging.StreamHandler) and
+                        not handler.filters and handler.stream is not None):
+                    head, _, tail = handler.format(record).partition('\0')
+                    text = ''.join(head + line + tail + '\n'
+                                   for line in lines)
+                    handler.acquire()
+                    try:
+                        handler.stream.write(text)
+                        handler.flush()
+                    finally:
+                        handler.release()
+                else:
+                    for line in lines:
+                        handler.handle(self.logger.makeRecord(
+                            self.logger.name, self.level, '(stage)', 0,
+                            line, None, None))
+            if not logger.propagate:
+                break
+            logger = logger.parent
+
 
 def set_env(line):
     if not line or not line.strip():
@@ -396,44 +2896,355 @@ def set_env(line):
     v = v or '1'
     log.info("New ENV variable: %s=%s" % (k, v))
     os.environ[k] = v
+    return k, v
+
+
+def load_envvars(options):
+    options.envvars_mtime = os.stat(options.envvars).st_mtime
+    with open(options.envvars, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0]
+            set_env(line)
 
 
 class EnvFIFO(threading.Thread):
+    """Control channel of a running stage. 'KEY=value' lines written to
+    deploy/deploy.cmd set environment variables; deploy/deploy.sock
+    accepts the same lines and the commands of control(), answering
+    each with one line. A session gets deploy/deploy-SESSION.cmd and
+    deploy/deploy-SESSION.sock instead."""
 
-    def __init__(self):
+    def __init__(self, handler=None, session=None):
+        import socket
         threading.Thread.__init__(self)
         self.daemon = True
-        self.fifo_name = 'deploy/deploy.cmd'
-        if os.path.exists(self.fifo_name):
-            os.unlink(self.fifo_name)
+        self.handler = handler
+        self.fifo_name = session_path('deploy/deploy.cmd', session)
+        self.sock_name = session_path('deploy/deploy.sock', session)
+        for name in (self.fifo_name, self.sock_name):
+            if os.path.exists(name):
+                os.unlink(name)
         os.mkfifo(self.fifo_name)
-        fifo_fd = os.open(self.fifo_name, os.O_RDONLY | os.O_NONBLOCK)
-        self.fifo = os.fdopen(fifo_fd, 'r', 0)
+        self.fifo_fd = os.open(self.fifo_name, os.O_RDONLY | os.O_NONBLOCK)
+        # keep a writer open, so the FIFO never reports EOF between writers
+        self.fifo_keep_fd = os.open(self.fifo_name, os.O_WRONLY)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.sock_name)
+        self.sock.listen(5)
+        self.socket_error = socket.error
+        self.wake_r, self.wake_w = os.pipe()
+        self.buffers = {self.fifo_fd: ''}
+        self.clients = dict()
         self.done = False
         self.start()
 
+    def read_lines(self, fd, data):
+        lines = (self.buffers.get(fd, '') + data).split('\n')
+        self.buffers[fd] = lines.pop()
+        return lines
+
     def read_fifo(self):
+        while True:
+            try:
+                data = os.read(self.fifo_fd, 4096)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise e
+                return
+            if not data:
+                return
+            for line in self.read_lines(self.fifo_fd, data):
+                reply = self.control(line)
+                if reply and reply != 'ok':
+                    log.info(reply)
+
+    def read_client(self, conn):
+        data = conn.recv(4096)
+        if not data:
+            self.close_client(conn)
+            return
+        for line in self.read_lines(conn.fileno(), data):
+            try:
+                conn.sendall(self.control(line) + '\n')
+            except self.socket_error:
+                self.close_client(conn)
+                return
+
+    def close_client(self, conn):
+        del self.clients[conn.fileno()]
+        self.buffers.pop(conn.fileno(), None)
+        conn.close()
+
+    def control(self, line):
+        """Apply one control line: KEY=value, set KEY=value, status,
+        abort or jobs N"""
+        line = line.strip()
+        if not line:
+            return ''
+        command, _, arg = line.partition(' ')
+        if command == 'set':
+            line, command = arg, ''
+        if command == 'status':
+            if self.handler is None:
+                return 'error: no deploy'
+            return json.dumps(self.handler.control_status())
+        elif command == 'abort':
+            if self.handler is None:
+                return 'error: no deploy'
+            return self.handler.control_abort()
+        elif command == 'jobs':
+            if self.handler is None or not arg.strip().isdigit():
+                return 'error: usage: jobs N'
+            return self.handler.control_jobs(int(arg))
+        elif '=' in line or command == '':
+            variable = set_env(line)
+            if variable and self.handler is not None:
+                self.handler.control_env(*variable)
+            return 'ok'
+        return 'error: unknown command %s' % command
+
+    def run(self):
+        while not self.done:
+            fds = [self.fifo_fd, self.sock, self.wake_r]
+            fds.extend(self.clients.values())
+            try:
+                ready = select.select(fds, [], [])[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise e
+            for fd in ready:
+                if fd == self.fifo_fd:
+                    self.read_fifo()
+                elif fd is self.sock:
+                    conn = self.sock.accept()[0]
+                    self.clients[conn.fileno()] = conn
+                elif fd != self.wake_r:
+                    self.read_client(fd)
+        self.read_fifo()
+
+    def close(self):
+        self.done = True
+        os.write(self.wake_w, 'x')
+        self.join()
+        for conn in self.clients.values():
+            conn.close()
+        self.sock.close()
+        for fd in (self.fifo_fd, self.fifo_keep_fd, self.wake_r,
+                   self.wake_w):
+            os.close(fd)
+        os.unlink(self.fifo_name)
+        os.unlink(self.sock_name)
+
+
+class Subscriber(object):
+    """Messages waiting for one 'n3d attach' client, at most max_size
+    bytes of them: the oldest are dropped and counted past that"""
+
+    def __init__(self, conn, max_size):
+        import socket
+        self.conn = conn
+        self.socket_error = socket.error
+        self.max_size = max_size
+        self.messages = collections.deque()
+        self.size = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def add(self, message):
+        self.messages.append(message)
+        self.size += len(message)
+        while self.size > self.max_size and len(self.messages) > 1:
+            # the first message may be sent in part already, keep it
+            index = self.sent and 1 or 0
+            dropped = self.messages[index]
+            del self.messages[index]
+            self.size -= len(dropped)
+            self.dropped += len(dropped)
+
+    def send(self):
+        """Send what the socket takes, False if the client is gone"""
+        while self.messages:
+            if not self.sent and self.dropped:
+                notice = 'dropped %i\n' % self.dropped
+                self.messages.appendleft(notice)
+                self.size += len(notice)
+                self.dropped = 0
+            message = self.messages[0]
+            try:
+                sent = self.conn.send(message[self.sent:])
+            except self.socket_error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                return False
+            self.sent += sent
+            if self.sent < len(message):
+                return True
+            self.messages.popleft()
+            self.size -= len(message)
+            self.sent = 0
+        return True
+
+
+class OutputBroadcast(threading.Thread):
+    """Raw stage output and stage start and finish entries served to any
+    number of read-only 'n3d attach' clients of a unix socket. Publishing
+    only queues the message for each client, a slow one loses its oldest
+    messages past buffer_size bytes, so no client can stall a stage.
+
+    Messages are 'out LENGTH LABEL\\n' followed by LENGTH bytes of output,
+    'event JSON\\n' and 'dropped BYTES\\n'."""
+
+    buffer_size = 1048576
+
+    def __init__(self, sock_name):
+        import socket
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock_name = os.path.abspath(sock_name)
+        if os.path.exists(sock_name):
+            os.unlink(sock_name)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(sock_name)
+        self.sock.listen(5)
+        self.socket_error = socket.error
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.lock = threading.Lock()
+        self.clients = dict()
+        self.done = False
+        self.start()
+
+    def publish(self, message):
+        if not self.clients:
+            return
+        with self.lock:
+            for client in self.clients.values():
+                client.add(message)
+        self.wake()
+
+    def output(self, label, data):
+        self.publish('out %i %s\n%s' % (len(data), label, data))
+
+    def event(self, entry):
+        self.publish('event %s\n' % json.dumps(entry, sort_keys=True))
+
+    def wake(self):
         try:
-            for line in iter(self.fifo.readline, ''):
-                set_env(line)
-        except IOError as e:
+            os.write(self.wake_w, 'x')
+        except OSError as e:
             if e.errno != errno.EAGAIN:
                 raise e
 
     def run(self):
         while not self.done:
-            self.read_fifo()
-            time.sleep(0.5)
+            with self.lock:
+                clients = self.clients.values()
+                writing = [c.conn for c in clients if c.messages]
+            try:
+                ready, writable = select.select(
+                    [self.sock, self.wake_r] + [c.conn for c in clients],
+                    writing, [])[:2]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise e
+            if self.wake_r in ready:
+                try:
+                    os.read(self.wake_r, 4096)
+                except OSError:
+                    pass
+            if self.sock in ready:
+                conn = self.sock.accept()[0]
+                conn.setblocking(0)
+                with self.lock:
+                    self.clients[conn.fileno()] = Subscriber(
+                        conn, self.buffer_size)
+            closed = set()
+            for conn in ready:
+                if conn in (self.sock, self.wake_r):
+                    continue
+                # clients send nothing, readable means gone
+                try:
+                    data = conn.recv(4096)
+                except self.socket_error:
+                    data = ''
+                if not data:
+                    self.close_client(conn)
+                    closed.add(conn)
+            for conn in writable:
+                # a client gone with messages queued is readable and
+                # writable, its socket is closed already
+                if conn in closed:
+                    continue
+                with self.lock:
+                    client = self.clients.get(conn.fileno())
+                    gone = client is not None and not client.send()
+                if gone:
+                    self.close_client(conn)
+
+    def close_client(self, conn):
+        with self.lock:
+            self.clients.pop(conn.fileno(), None)
+        conn.close()
 
     def close(self):
+        """Stop after sending clients what they have queued, as far as
+        they take it at once"""
         self.done = True
-        self.read_fifo()
-        self.fifo.close()
-        os.unlink(self.fifo_name)
+        self.wake()
+        self.join()
+        for client in self.clients.values():
+            client.conn.setblocking(1)
+            client.conn.settimeout(1)
+            client.send()
+            client.conn.close()
+        self.sock.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+        os.unlink(self.sock_name)
+
+
+def attach(sock_name):
+    """Print the output and stage events of a running n3d until it
+    exits, return the exit status"""
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sock_name)
+    except socket.error as e:
+        log.error('Can not attach to %s: %s' % (sock_name, e.args[-1]))
+        return 1
+    stream = sock.makefile('rb')
+    prefixers = dict()
+    try:
+        for header in iter(stream.readline, ''):
+            kind, _, arg = header.rstrip('\n').partition(' ')
+            if kind == 'out':
+                length, _, label = arg.partition(' ')
+                if label not in prefixers:
+                    prefixers[label] = LinePrefixer(label + ' : ')
+                data = prefixers[label](stream.read(int(length)))
+            elif kind == 'event':
+                data = ''.join(prefixer.finish()
+                               for prefixer in prefixers.values())
+                data += format_entry(json_str(json.loads(arg))) + '\n'
+            elif kind == 'dropped':
+                data = '... %s bytes of output dropped\n' % arg
+            else:
+                continue
+            sys.stdout.write(data)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    return 0
 
 
 def readline_colored(text, color=None, on_color=None, attrs=None):
     if os.getenv('ANSI_COLORS_DISABLED') is None:
+        import termcolor
         fmt_str = '\001\033[%dm\002%s'
         if color is not None:
             text = fmt_str % (termcolor.COLORS[color], text)
@@ -462,19 +3273,103 @@ class ColoredFormatter(logging.Formatter):
     def format(self, record):
         result = logging.Formatter.format(self, record)
         if result is not None:
+            import termcolor
             return termcolor.colored(result, self.colors[record.levelname])
 
 
-def main():
-    global tty_path
-    global tty_owner
-    optionparser = OptionParser(usage="usage: %prog [options]")
+def readonly_command(options, args):
+    """list, status, journal, check, env and cat subcommands: read the stage
+    catalog and the deploy journal without a TTY, lock or log file, and
+    attach to the output of a running n3d. Return the exit status."""
+    if args[0] == 'attach':
+        sock_name = session_path('deploy/deploy.out', options.session)
+        return attach(os.path.relpath(os.path.join(options.work_dir,
+                                                   sock_name)))
+    deploy = DeployCmd()
+    deploy.options = options
+    deploy.read_state(readonly=True)
+    if args[0] == 'list':
+        for line in deploy.list_lines():
+            print line
+    elif args[0] == 'status':
+        status = deploy.process_status()
+        if options.json:
+            print json.dumps(status, sort_keys=True)
+            return 0
+        for key in ('run', 'current', 'next', 'stages', 'finished'):
+            print "%s: %s" % (key, status[key])
+        print "done: %s" % ','.join(status['done'])
+        print "running: %s" % ','.join(status['running'])
+        if status['tty']:
+            print "tty: %(path)s (%(owner)s)" % status['tty']
+        if status['lock']:
+            print "lock: %s" % status['lock']
+    elif args[0] == 'check':
+        deploy.checks = JSONStore(session_path(options.checks_file,
+                                               options.session))
+        if not deploy.preflight(range(len(deploy.stages))):
+            return 1
+    elif args[0] == 'journal':
+        run = ' '.join(args[1:])
+        if options.json and run:
+            entries = deploy.journal.runs().get(run)
+            if entries is None:
+                log.error('No such run in the journal')
+                return 1
+            for entry in entries:
+                print json.dumps(entry, sort_keys=True)
+            return 0
+        lines = deploy.journal_lines(run)
+        if lines is None:
+            log.error('No such run in the journal')
+            return 1
+        for line in lines:
+            print line
+    elif args[0] == 'env':
+        deploy.env_store = EnvStore(session_path(options.env_file,
+                                                 options.session),
+                                    deploy.run_id)
+        lines = deploy.env_lines(' '.join(args[1:]))
+        if lines is None:
+            return 1
+        for line in lines:
+            print line
+    elif args[0] == 'cat':
+        path = deploy.cat_path(' '.join(args[1:]))
+        if path is None:
+            return 1
+        with open(path, 'r') as f:
+            sys.stdout.write(f.read())
+    return 0
+
+
+def option_parser():
+    optionparser = OptionParser(usage="usage: %prog [options] [list | "
+                                "status | journal [RUN] | check | "
+                                "env [STAGE] | cat [STAGE] | attach]")
     optionparser.add_option("-s", "--stages-dir", dest="stages_dir",
                             default=os.path.join("deploy", "stages"),
                             help="stages root directory [ default: %default ]")
     optionparser.add_option("-w", "--work-dir", dest="work_dir",
                             default=os.getcwd(),
                             help="working directory [ current: %default ]")
+    optionparser.add_option("-t", "--target", action="append",
+                            dest="targets",
+                            help="run every stage in this directory instead\
+                            of the working directory, may be repeated for\
+                            a fan-out deploy")
+    optionparser.add_option("--target-jobs", dest="target_jobs", type="int",
+                            default=4,
+                            help="targets running a stage at once\
+                            [ default: %default ]")
+    optionparser.add_option("--on-failure", dest="on_failure",
+                            type="choice",
+                            choices=["stop", "continue", "canary"],
+                            default="stop",
+                            help="when a stage fails on a target: stop all\
+                            targets, continue the others, or run the first\
+                            target alone before the rest\
+                            [ default: %default ]")
     optionparser.add_option("-l", "--log-file", dest="log_file",
                             default=os.path.join("deploy",
                                                  "deploy_process.log"),
@@ -483,7 +3378,118 @@ def main():
                             default=os.path.join("deploy",
                                                  "deploy_process.ini"),
                             help="The file containing the current stage of the\
-                            deployment process [ default: %default ]")
+                            deployment process, as written by older n3d,\
+                            read if there is no journal yet\
+                            [ default: %default ]")
+    optionparser.add_option("--lock-file", dest="lock_file",
+                            default=os.path.join("deploy", "stage.lock"),
+                            help="lock held while stages run, relative to\
+                            the working directory [ default: %default ]")
+    optionparser.add_option("--locks-dir", dest="locks_dir",
+                            default=os.path.join("deploy", "locks"),
+                            help="directory of the '# n3d-locks:' resource\
+                            locks, relative to the working directory\
+                            [ default: %default ]")
+    optionparser.add_option("--session", dest="session",
+                            help="name of an n3d session running next to\
+                            others in the same working directory: it gets\
+                            its own journal, lock and control channel")
+    optionparser.add_option("--journal-file", dest="journal_file",
+                            default=os.path.join("deploy",
+                                                 "deploy_journal.jsonl"),
+                            help="append-only journal of the deploy position\
+                            and stage runs [ default: %default ]")
+    optionparser.add_option("--stages-cache", dest="stages_cache",
+                            default=os.path.join("deploy", "stages.cache"),
+                            help="stages catalog cache file, empty to\
+                            disable [ default: %default ]")
+    optionparser.add_option("--output-dir", dest="output_dir",
+                            default=os.path.join("deploy", "output"),
+                            help="stage output store directory, empty to\
+                            disable [ default: %default ]")
+    optionparser.add_option("--keep-runs", dest="keep_runs", type="int",
+                            default=20,
+                            help="deploy runs kept in the output store\
+                            [ default: %default ]")
+    optionparser.add_option("--history-file", dest="history_file",
+                            default=os.path.join("deploy",
+                                                 "stage_history.json"),
+                            help="stage run time history, empty to disable\
+                            [ default: %default ]")
+    optionparser.add_option("--metrics-file", dest="metrics_file",
+                            help="write stage run time metrics to this\
+                            Prometheus text file")
+    optionparser.add_option("--incremental", action="store_true",
+                            dest="incremental", default=False,
+                            help="skip stages with '# n3d-inputs:' header\
+                            when their script, inputs and '# n3d-env:'\
+                            variables did not change since their last\
+                            success")
+    optionparser.add_option("--force", action="store_true", dest="force",
+                            default=False,
+                            help="with --incremental, run all stages anyway")
+    optionparser.add_option("--fingerprints-file", dest="fingerprints_file",
+                            default=os.path.join("deploy",
+                                                 "fingerprints.json"),
+                            help="fingerprints of the last successful stage\
+                            runs [ default: %default ]")
+    optionparser.add_option("--stage-timeout", dest="stage_timeout",
+                            default="0",
+                            help="kill a stage running longer than this,\
+                            like 90, 30s, 10m or 1h, unless its\
+                            '# n3d-timeout:' header says otherwise, 0 for\
+                            none [ default: %default ]")
+    optionparser.add_option("--idle-timeout", dest="idle_timeout",
+                            default="0",
+                            help="kill a stage silent for this long, unless\
+                            its '# n3d-idle-timeout:' header says otherwise,\
+                            0 for none [ default: %default ]")
+    optionparser.add_option("--retries", dest="retries", type="int",
+                            default=0,
+                            help="run a failed stage again up to this many\
+                            times, unless its '# n3d-retries:' header says\
+                            otherwise [ default: %default ]")
+    optionparser.add_option("--retry-delay", dest="retry_delay",
+                            default="10s",
+                            help="wait before the first retry, doubled for\
+                            each next one, unless the '# n3d-retry-delay:'\
+                            header says otherwise [ default: %default ]")
+    optionparser.add_option("--prepare-ahead", dest="prepare_ahead",
+                            type="int", default=2,
+                            help="stages ahead whose '.prepare' action runs\
+                            in the background while earlier stages run\
+                            [ default: %default ]")
+    optionparser.add_option("--prepare-jobs", dest="prepare_jobs",
+                            type="int", default=2,
+                            help="'.prepare' actions running ahead at once\
+                            [ default: %default ]")
+    optionparser.add_option("--no-check", action="store_false", dest="check",
+                            default=True,
+                            help="do not check the stages left before\
+                            continue")
+    optionparser.add_option("--check-jobs", dest="check_jobs", type="int",
+                            default=8,
+                            help="stage scripts checked at once\
+                            [ default: %default ]")
+    optionparser.add_option("--env-file", dest="env_file",
+                            default=os.path.join("deploy", "env.json"),
+                            help="variables published by the stages of the\
+                            current run, restored when n3d starts again\
+                            [ default: %default ]")
+    optionparser.add_option("--checks-file", dest="checks_file",
+                            default=os.path.join("deploy", "checks.json"),
+                            help="stage files whose syntax check passed,\
+                            empty to disable [ default: %default ]")
+    optionparser.add_option("--output-mode", dest="output_mode",
+                            type="choice", choices=["full", "summary"],
+                            default="full",
+                            help="show all stage output on the terminal, or\
+                            only a throttled view of its last lines (the\
+                            log gets all of it) [ default: %default ]")
+    optionparser.add_option("--summary-lines", dest="summary_lines",
+                            type="int", default=10,
+                            help="lines shown in summary output mode\
+                            [ default: %default ]")
     optionparser.add_option("-E", "--env", action="append", dest="envs",
                             help="Add environment variable for stages")
     optionparser.add_option("-c", "--envvars", dest="envvars",
@@ -495,6 +3501,36 @@ def main():
                             default=False,
                             help="run all stages while stage exit status is 0,\
                             exit after all done stages")
+    optionparser.add_option("-j", "--jobs", dest="jobs", type="int",
+                            default=1,
+                            help="run up to JOBS independent stages at once\
+                            on continue [ default: %default ]")
+    optionparser.add_option("--headless", action="store_true",
+                            dest="headless", default=False,
+                            help="run stages without a terminal, output\
+                            prefixed by stage name, commands from stdin")
+    optionparser.add_option("--reload-mode", dest="reload_mode",
+                            type="choice", choices=["inprocess", "exec"],
+                            default="inprocess",
+                            help="how to apply RELOAD_DEPLOY: reload n3d\
+                            in place or restart the process\
+                            [ default: %default ]")
+    optionparser.add_option("--trace", dest="trace",
+                            help="append Chrome trace events of n3d phases\
+                            and stage runs to this file, for\
+                            chrome://tracing or Perfetto")
+    optionparser.add_option("--json", action="store_true", dest="json",
+                            default=False,
+                            help="status subcommand output, and journal RUN\
+                            entries, as JSON")
+    return optionparser
+
+
+def main():
+    global tty_path
+    global tty_owner
+    global tracer
+    optionparser = option_parser()
     (options, args) = optionparser.parse_args()
     if not os.path.exists(options.stages_dir):
         print "Stages directory not found: %s" % options.stages_dir
@@ -502,11 +3538,37 @@ def main():
     if not os.path.exists(options.work_dir):
         print "Working directory not found: %s" % options.work_dir
         sys.exit(1)
-    if sys.stdin.isatty():
+    options.targets = [os.path.abspath(t) for t in options.targets or []]
+    for target in options.targets:
+        if not os.path.isdir(target):
+            print "Target directory not found: %s" % target
+            sys.exit(1)
+    # state files are written from stage and control threads too, while
+    # the working directory is the current one
+    for name in ('log_file', 'process_file', 'journal_file', 'stages_cache',
+                 'output_dir', 'history_file', 'metrics_file',
+                 'fingerprints_file', 'env_file', 'checks_file'):
+        if getattr(options, name):
+            setattr(options, name, os.path.abspath(getattr(options, name)))
+    for name in ('stage_timeout', 'idle_timeout', 'retry_delay'):
+        try:
+            parse_duration(getattr(options, name))
+        except ValueError as e:
+            optionparser.error(e)
+    if args:
+        if args[0] not in ('list', 'status', 'journal', 'check', 'env',
+                           'cat', 'attach'):
+            optionparser.error("unknown command: %s" % args[0])
+        logging.basicConfig(format='%(message)s', level=logging.INFO)
+        sys.exit(readonly_command(options, args))
+    if options.headless:
+        tty_path = 'headless'
+        tty_owner = pwd.getpwuid(os.getuid()).pw_name
+    elif sys.stdin.isatty():
         tty_path = os.ttyname(sys.stdin.fileno())
         tty_owner = pwd.getpwuid(os.stat(tty_path).st_uid).pw_name
     else:
-        print "You must have a TTY"
+        print "You must have a TTY, or use --headless"
         sys.exit(1)
     logging.basicConfig(filename=options.log_file,
                         format='%(asctime)s (' + tty_owner + ') %(message)s',
@@ -516,18 +3578,27 @@ def main():
     ch.setFormatter(ColoredFormatter())
     log.addHandler(ch)
     if os.path.exists(options.envvars):
-        with open(options.envvars, 'r') as f:
-            for line in f:
-                line = line.split('#', 1)[0]
-                set_env(line)
+        load_envvars(options)
     if options.envs:
         for line in options.envs:
             set_env(line)
+    if options.session:
+        os.environ['N3D_SESSION'] = options.session
+    if options.trace:
+        tracer = Tracer(options.trace)
+        restart = os.environ.pop('N3D_TRACE_RESTART', None)
+        if restart is not None:
+            tracer.complete('restart', float(restart))
+    deploy = DeployCmd()
     try:
-        DeployCmd().cmdloop(options=options)
+        deploy.cmdloop(options=options)
     except KeyboardInterrupt:
+        if hasattr(deploy, 'aborted'):
+            deploy.kill_stages()
         log.info("exit")
         sys.exit(1)
+    if options.headless:
+        sys.exit(deploy.exit_code)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,718 @@
+#!/usr/bin/env python
+"""Unit tests of the n3d helpers, run by
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import json
+import time
+import errno
+import subprocess
+import shutil
+import socket
+import logging
+import StringIO
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
+import n3d
+
+n3d.log.addHandler(logging.NullHandler())
+n3d.log.propagate = False
+
+
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='n3d-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+
+class DeployJournalTest(TempDirTestCase):
+
+    def journal(self, **kwargs):
+        journal = n3d.DeployJournal(self.path('journal.jsonl'), **kwargs)
+        self.addCleanup(journal.close)
+        return journal
+
+    def entries(self):
+        with open(self.path('journal.jsonl')) as f:
+            return [json.loads(line) for line in f]
+
+    def test_update_journals_delta(self):
+        journal = self.journal()
+        journal.update(dict(run='r1', current=None, next='01-a',
+                            done=[], running=['01-a']))
+        journal.update(dict(run='r1', current='01-a', next='02-b',
+                            done=['01-a'], running=[]))
+        journal.update(dict(run='r1', current='01-a', next='02-b',
+                            done=['01-a'], running=[]))
+        entries = self.entries()
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[1]['set'], dict(current='01-a',
+                                                 next='02-b'))
+        self.assertEqual(entries[1]['add'], dict(done=['01-a']))
+        self.assertEqual(entries[1]['remove'], dict(running=['01-a']))
+
+    def test_load_replays_since_snapshot(self):
+        journal = self.journal()
+        journal.update(dict(run='r1', next='02-b', done=['01-a']))
+        journal.reset()
+        journal.update(dict(run='r2', next='03-c', done=['02-b'],
+                            targets=dict(web=dict(done=['02-b'],
+                                                  failed=[]))))
+        journal.record('start', run='r2', stage='03-c')
+        journal.update(dict(current='03-c', running=['03-c']))
+        state = self.journal().state
+        self.assertEqual(state['run'], 'r2')
+        self.assertEqual(state['current'], '03-c')
+        self.assertEqual(state['next'], '03-c')
+        self.assertEqual(state['done'], set(['02-b']))
+        self.assertEqual(state['running'], set(['03-c']))
+        self.assertEqual(state['targets'],
+                         dict(web=dict(done=['02-b'], failed=[])))
+
+    def test_reset_starts_anew(self):
+        journal = self.journal()
+        journal.update(dict(run='r1', done=['01-a']))
+        journal.reset()
+        self.assertEqual(self.journal().state,
+                         n3d.DeployJournal.empty_state())
+
+    def test_compaction(self):
+        journal = self.journal(keep_runs=2)
+        journal.compact_entries = 5
+        for run in ('r1', 'r2', 'r3'):
+            journal.record('start', run=run, stage='01-a')
+            journal.record('finish', run=run, stage='01-a', status=0)
+        for stage in range(10):
+            journal.update(dict(run='r3', done=['%02i' % s
+                                                for s in range(stage)]))
+        entries = self.entries()
+        self.assertTrue(len(entries) < 10)
+        self.assertEqual(journal.runs().keys(), ['r2', 'r3'])
+        self.assertEqual(self.journal().state['done'],
+                         set('%02i' % s for s in range(9)))
+        self.assertFalse(os.path.exists(self.path('journal.jsonl.tmp')))
+
+    def test_last_run(self):
+        journal = self.journal()
+        for run in ('r1', 'r2'):
+            journal.record('start', run=run, stage='01-a')
+            journal.record('finish', run=run, stage='01-a', status=0)
+            journal.update(dict(run=run, done=['01-a']))
+        self.assertEqual([(e['event'], e['run'])
+                          for e in journal.last_run('r2')],
+                         [('start', 'r2'), ('finish', 'r2')])
+        self.assertEqual(journal.last_run('r3'), [])
+        self.assertEqual(journal.last_run(None), [])
+
+    def test_torn_line(self):
+        journal = self.journal()
+        journal.update(dict(run='r1', next='02-b', done=['01-a']))
+        journal.close()
+        with open(self.path('journal.jsonl'), 'a') as f:
+            f.write('{"event": "state", "set": {"next": "03')
+        journal = self.journal()
+        self.assertEqual(journal.state['next'], '02-b')
+        journal.update(dict(next='03-c', done=['01-a', '02-b']))
+        self.assertEqual(len(list(journal.read())), 2)
+        state = self.journal().state
+        self.assertEqual(state['next'], '03-c')
+        self.assertEqual(state['done'], set(['01-a', '02-b']))
+
+
+class DeployTestCase(TempDirTestCase):
+    """Stages in a temporary working directory, deployed by a headless
+    n3d"""
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        os.makedirs(self.path('deploy/stages'))
+
+    def add_stage(self, name, script, interpreter='/bin/sh'):
+        path = self.path('deploy/stages/' + name)
+        with open(path, 'w') as f:
+            f.write('#!%s\n%s\n' % (interpreter, script))
+        os.chmod(path, 0755)
+        return path
+
+    def n3d(self, *args):
+        """Exit status and output of n3d run in the working directory"""
+        env = dict(os.environ, ANSI_COLORS_DISABLED='1')
+        proc = subprocess.Popen(
+            [sys.executable, os.path.splitext(n3d.__file__)[0] + '.py'] +
+            list(args), cwd=self.dir, env=env, stdin=open(os.devnull),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        return proc.returncode, output
+
+    def runs(self):
+        """'start' and 'finish' entries of the journal, oldest first"""
+        with open(self.path('deploy/deploy_journal.jsonl')) as f:
+            return [entry for entry in map(json.loads, f)
+                    if entry['event'] in ('start', 'finish')]
+
+
+class SchedulerTest(DeployTestCase):
+
+    def times(self):
+        times = dict()
+        for entry in self.runs():
+            times[entry['stage'], entry['event']] = entry['time']
+        return times
+
+    def test_independent_stages_run_concurrently(self):
+        # waiting longer than a second for a stage must not stop the
+        # scheduler
+        self.add_stage('01-a.update', 'sleep 1.5')
+        self.add_stage('02-b.update', '# n3d-depends:\nsleep 0.1')
+        self.add_stage('03-c.update', '# n3d-depends: a\ntrue')
+        status, output = self.n3d('--headless', '-r', '-j', '2')
+        self.assertEqual(status, 0, output)
+        times = self.times()
+        self.assertTrue(times['02-b', 'finish'] < times['01-a', 'finish'])
+        self.assertTrue(times['03-c', 'start'] >= times['01-a', 'finish'])
+
+    def test_failure_stops_launches(self):
+        self.add_stage('01-a.update', 'sleep 0.5')
+        self.add_stage('02-b.update', '# n3d-depends:\nexit 3')
+        self.add_stage('03-c.update', 'true')
+        status, output = self.n3d('--headless', '-r', '-j', '2')
+        self.assertEqual(status, 1, output)
+        times = self.times()
+        self.assertTrue(('01-a', 'finish') in times)
+        self.assertFalse(('03-c', 'start') in times)
+
+    def test_unknown_dependency(self):
+        self.add_stage('01-a.update', '# n3d-depends: nothing\ntrue')
+        status, output = self.n3d('--headless', '-r', '-j', '2')
+        self.assertEqual(status, 1)
+        self.assertTrue('depends on unknown stage nothing' in output,
+                        output)
+
+
+class StageCatalogTest(DeployTestCase):
+
+    def catalog(self, readonly=False):
+        catalog = n3d.StageCatalog(self.path('deploy/stages'),
+                                   self.path('stages.cache'))
+        catalog.scan(readonly)
+        return catalog
+
+    def test_scan_and_lookup(self):
+        self.add_stage('01-build.update', '# n3d-timeout: 10m')
+        self.add_stage('01-build.rollback', 'true')
+        os.makedirs(self.path('deploy/stages/web'))
+        self.add_stage('web/02-restart.update', 'true')
+        self.add_stage('web/notes.txt', 'not a stage')
+        catalog = self.catalog()
+        self.assertEqual(catalog.names, ['01-build', '02-restart'])
+        self.assertEqual(sorted(catalog.stages['01-build']),
+                         ['rollback', 'update'])
+        self.assertEqual(catalog.headers['01-build'], dict(timeout='10m'))
+        for line in ('restart', '02', '02-restart', '1'):
+            self.assertEqual(catalog.lookup(line), 1)
+        self.assertEqual(catalog.lookup('5'), None)
+        self.assertEqual(catalog.lookup('deploy'), None)
+
+    def test_fixes_mode(self):
+        path = self.add_stage('01-a.update', 'true')
+        os.chmod(path, 0644)
+        self.catalog(readonly=True)
+        self.assertEqual(os.stat(path).st_mode & 0777, 0644)
+        self.catalog()
+        self.assertEqual(os.stat(path).st_mode & 0777, 0700)
+
+    def test_cache(self):
+        path = self.add_stage('01-a.update', '# n3d-depends:')
+        self.add_stage('02-b.update', 'true')
+        self.catalog()
+        read = list()
+        read_stage_headers = n3d.read_stage_headers
+        n3d.read_stage_headers = lambda path: (
+            read.append(os.path.basename(path)) or read_stage_headers(path))
+        try:
+            self.assertEqual(self.catalog().headers['01-a'],
+                             dict(depends=''))
+            self.assertEqual(read, [])
+            with open(path, 'a') as f:
+                f.write('# n3d-retries: 2\n')
+            self.add_stage('03-c.update', 'true')
+            catalog = self.catalog()
+        finally:
+            n3d.read_stage_headers = read_stage_headers
+        self.assertEqual(sorted(read), ['01-a.update', '03-c.update'])
+        self.assertEqual(catalog.names, ['01-a', '02-b', '03-c'])
+        os.unlink(path)
+        self.assertEqual(self.catalog().names, ['02-b', '03-c'])
+
+    def test_readonly_and_broken_cache(self):
+        self.add_stage('01-a.update', 'true')
+        self.catalog(readonly=True)
+        self.assertFalse(os.path.exists(self.path('stages.cache')))
+        with open(self.path('stages.cache'), 'w') as f:
+            f.write('{"not": "marshal"}')
+        self.assertEqual(self.catalog().names, ['01-a'])
+        self.assertEqual(self.catalog(readonly=True).names, ['01-a'])
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = list()
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class LogWrapperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('LogWrapper')
+        self.stream = StringIO.StringIO()
+        stream_handler = logging.StreamHandler(self.stream)
+        stream_handler.setFormatter(logging.Formatter('> %(message)s <'))
+        self.list_handler = ListHandler()
+        for handler in (stream_handler, self.list_handler):
+            self.logger.addHandler(handler)
+            self.addCleanup(self.logger.removeHandler, handler)
+        self.addCleanup(setattr, self.logger, 'propagate',
+                        self.logger.propagate)
+        self.logger.propagate = False
+        self.addCleanup(self.logger.setLevel, self.logger.level)
+        self.logger.setLevel(logging.DEBUG)
+
+    def log(self, *chunks, **kwargs):
+        wrapper = n3d.LogWrapper(**kwargs)
+        for chunk in chunks:
+            wrapper.write(chunk)
+        wrapper.close()
+        return self.list_handler.messages
+
+    def test_lines(self):
+        lines = self.log('one\ntw', 'o\nthr', 'ee\r\nfour  \n', u'f\xefve',
+                         batch_size=2)
+        self.assertEqual(lines, ['one', 'two', 'three', 'four',
+                                 'f\xc3\xafve'])
+        self.assertEqual(self.stream.getvalue(),
+                         ''.join('> %s <\n' % line for line in lines))
+
+    def test_carriage_return(self):
+        self.assertEqual(self.log('10%\r', '50%\r100%\r', '\ndone\n'),
+                         ['100%', 'done'])
+
+    def test_output(self):
+        output = list()
+        self.log('a\n', 'b', '', 'c\n', output=output.append)
+        self.assertEqual(''.join(output), 'a\nbc\n')
+
+
+class OutputStoreTest(TempDirTestCase):
+
+    def store(self, run, keep_runs=20):
+        store = n3d.OutputStore(self.path('output'), run, keep_runs)
+        self.addCleanup(store.close)
+        return store
+
+    def test_attempts(self):
+        store = self.store('r1')
+        first = store.open_stage('01-a')
+        other = store.open_stage('02-b')
+        first('one\n')
+        other('other\n')
+        first('two\n')
+        store.open_stage('01-a')('retry\n')
+        self.assertEqual(''.join(store.read('r1', '01-a', 1)),
+                         'one\ntwo\n')
+        self.assertEqual(''.join(store.read('r1', '01-a')), 'retry\n')
+        self.assertEqual(list(store.read('r1', '03-c')), [])
+        store.close()
+        store = self.store('r1')
+        store.open_stage('01-a')('again\n')
+        self.assertEqual(''.join(store.read('r1', '01-a')), 'again\n')
+
+    def test_cleanup(self):
+        for run in ('r1', 'r2', 'r3'):
+            store = self.store(run, keep_runs=2)
+            store.open_stage('01-a')(run + '\n')
+            store.close()
+        self.store('r4', keep_runs=2)
+        self.assertEqual(sorted(os.listdir(self.path('output'))),
+                         ['r2.idx', 'r2.out.gz', 'r3.idx', 'r3.out',
+                          'r4.idx', 'r4.out'])
+        store = self.store('r4', keep_runs=2)
+        self.assertEqual(''.join(store.read('r2', '01-a')), 'r2\n')
+        self.assertEqual(''.join(store.read('r3', '01-a')), 'r3\n')
+        self.assertEqual(list(store.read('r1', '01-a')), [])
+
+
+class StageHistoryTest(TempDirTestCase):
+
+    def test_stats(self):
+        history = n3d.StageHistory(self.path('history.json'))
+        for duration, status in ((4, 0), (1, 0), (3, 2), (2, 0)):
+            history.record('01-a', 'r1', duration, status)
+        history = n3d.StageHistory(self.path('history.json'))
+        self.assertEqual(history.stats('01-a'),
+                         dict(runs=4, failures=1, failure_rate=0.25, p50=2,
+                              p95=4, last=2, last_status=0,
+                              last_usage=None))
+        self.assertEqual(history.estimate('01-a'), 2)
+        self.assertEqual(history.stats('02-b'), None)
+        self.assertEqual(history.estimate('02-b'), None)
+
+    def test_compaction(self):
+
+        class ShortHistory(n3d.StageHistory):
+            limit = 2
+
+        history = ShortHistory(self.path('history.json'))
+        for duration in range(5):
+            history.record('01-a', 'r1', duration, 0)
+        with open(self.path('history.json'), 'a') as f:
+            f.write('{"torn\n')
+        history = ShortHistory(self.path('history.json'))
+        with open(self.path('history.json')) as f:
+            self.assertEqual([json.loads(line)['duration'] for line in f],
+                             [3, 4])
+        self.assertEqual(history.stats('01-a')['runs'], 2)
+
+    def test_metrics(self):
+        history = n3d.StageHistory(self.path('history.json'),
+                                   self.path('metrics.prom'))
+        history.record('01-a', 'r1', 1.5, 0, dict(user=1, sys=0.5,
+                                                 maxrss=1024, inblock=0,
+                                                 oublock=8))
+        history.record('02-b', 'r1', 2, 3)
+        with open(self.path('metrics.prom')) as f:
+            metrics = f.read().splitlines()
+        for line in ('n3d_stage_last_duration_seconds{stage="01-a"} 1.5',
+                     'n3d_stage_last_status{stage="02-b"} 3',
+                     'n3d_stage_failure_ratio{stage="02-b"} 1.0',
+                     'n3d_stage_last_cpu_seconds{stage="01-a"} 1.5',
+                     'n3d_stage_last_cpu_seconds{stage="02-b"} NaN',
+                     '# TYPE n3d_stage_runs gauge'):
+            self.assertTrue(line in metrics, line)
+
+
+class IncrementalTest(DeployTestCase):
+
+    def setUp(self):
+        DeployTestCase.setUp(self)
+        self.add_stage('01-build.update',
+                       '# n3d-inputs: src/\n# n3d-env: BUILD_ENV\n'
+                       'echo built >> built.txt')
+        self.add_stage('02-plain.update', 'echo run >> plain.txt')
+        os.makedirs(self.path('src'))
+        self.write('src/main.c', 'int main;')
+
+    def write(self, name, data):
+        with open(self.path(name), 'w') as f:
+            f.write(data)
+
+    def deploy(self, *args):
+        status, output = self.n3d('--headless', '-r', '--incremental',
+                                  *args)
+        self.assertEqual(status, 0, output)
+        with open(self.path('built.txt')) as f:
+            return len(f.readlines())
+
+    def test_skips_unchanged(self):
+        self.assertEqual(self.deploy(), 1)
+        self.assertEqual(self.deploy(), 1)
+        with open(self.path('plain.txt')) as f:
+            self.assertEqual(len(f.readlines()), 2)
+        self.write('src/main.c', 'int main();')
+        self.assertEqual(self.deploy(), 2)
+        self.write('src/util.c', '')
+        self.assertEqual(self.deploy(), 3)
+        self.assertEqual(self.deploy('-E', 'BUILD_ENV=prod'), 4)
+        self.assertEqual(self.deploy('-E', 'BUILD_ENV=prod'), 4)
+        self.assertEqual(self.deploy('-E', 'BUILD_ENV=prod', '--force'), 5)
+
+    def test_failure_not_remembered(self):
+        # the failed stage is the last one, the next deploy starts over
+        os.unlink(self.path('deploy/stages/02-plain.update'))
+        self.add_stage('01-build.update',
+                       '# n3d-inputs: src/\necho built >> built.txt\n'
+                       'test -f ok')
+        status, output = self.n3d('--headless', '-r', '--incremental')
+        self.assertEqual(status, 1, output)
+        self.write('ok', '')
+        self.assertEqual(self.deploy(), 2)
+        self.assertEqual(self.deploy(), 2)
+
+
+class LinePrefixerTest(unittest.TestCase):
+
+    def test_prefixes_lines_across_chunks(self):
+        prefixer = n3d.LinePrefixer('a : ')
+        output = ''.join(prefixer(chunk) for chunk in
+                         ('one\ntw', 'o\n', '', 'three\nfour'))
+        self.assertEqual(output, 'a : one\na : two\na : three\na : four')
+
+    def test_finish(self):
+        prefixer = n3d.LinePrefixer('a : ')
+        self.assertEqual(prefixer.finish(), '')
+        prefixer('last')
+        self.assertEqual(prefixer.finish(), '\n')
+        self.assertEqual(prefixer.finish(), '')
+        self.assertEqual(prefixer('next\n'), 'a : next\n')
+
+
+class ParseDurationTest(unittest.TestCase):
+
+    def test_durations(self):
+        for value, seconds in ((90, 90), ('1.5', 1.5), ('1.5s', 1.5),
+                               ('10m', 600), ('2h', 7200), ('1d', 86400),
+                               ('1h30m', 5400), (' 30s ', 30)):
+            self.assertEqual(n3d.parse_duration(value), seconds)
+
+    def test_bad_durations(self):
+        for value in ('', 'm', '10x', '1h30', 'h1'):
+            self.assertRaises(ValueError, n3d.parse_duration, value)
+
+
+class FileLockTest(TempDirTestCase):
+
+    def dead_pid(self):
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        return pid
+
+    def test_exclusive(self):
+        lock = n3d.FileLock(self.path('locks/stage.lock'))
+        other = n3d.FileLock(self.path('locks/stage.lock'))
+        self.assertEqual(lock.holder(), None)
+        self.assertTrue(lock.acquire('01-a'))
+        self.assertFalse(other.acquire('02-b'))
+        self.assertEqual(other.holder(), '01-a (pid %s on %s)'
+                         % (os.getpid(), os.uname()[1]))
+        lock.release()
+        self.assertEqual(other.holder(), None)
+        self.assertTrue(other.acquire('02-b'))
+        other.release()
+
+    def take_over(self, holder):
+        with open(self.path('stage.lock'), 'w') as f:
+            f.write(holder)
+        lock = n3d.FileLock(self.path('stage.lock'))
+        self.assertTrue(lock.acquire('02-b'))
+        with open(self.path('stage.lock')) as f:
+            self.assertEqual(json.load(f)['label'], '02-b')
+        lock.release()
+
+    def test_takes_over_stale_lock(self):
+        holder = json.dumps(dict(label='01-a', pid=self.dead_pid(),
+                                 host=os.uname()[1]))
+        with open(self.path('stage.lock'), 'w') as f:
+            f.write(holder)
+        self.assertEqual(n3d.FileLock(self.path('stage.lock')).holder(),
+                         None)
+        self.take_over(holder)
+        # written by an older n3d
+        self.take_over('continue')
+
+    def test_other_host_alive(self):
+        lock = n3d.FileLock(self.path('stage.lock'))
+        self.assertTrue(lock.alive(dict(label='01-a', pid=self.dead_pid(),
+                                        host='elsewhere')))
+
+
+class SessionPathTest(unittest.TestCase):
+
+    def test_session_path(self):
+        self.assertEqual(n3d.session_path('deploy/env.json', 'web'),
+                         'deploy/env-web.json')
+        self.assertEqual(n3d.session_path('deploy/output', 'web'),
+                         'deploy/output-web')
+        self.assertEqual(n3d.session_path('deploy/env.json', None),
+                         'deploy/env.json')
+        self.assertEqual(n3d.session_path('', 'web'), '')
+
+
+class CheckScriptTest(DeployTestCase):
+
+    def check(self, script, interpreter='/bin/sh'):
+        return n3d.check_script(self.add_stage('01-a.update', script,
+                                               interpreter))
+
+    def test_problems(self):
+        self.assertEqual(self.check('echo ok'), [])
+        self.assertEqual(self.check('pass', sys.executable), [])
+        self.assertEqual(self.check('if true; then', '/usr/bin/env sh')[0]
+                         [:14], 'syntax error: ')
+        self.assertEqual(self.check('def (', sys.executable)[0][:14],
+                         'syntax error: ')
+        self.assertEqual(self.check('true', '/no/such/sh'),
+                         ['interpreter not found: /no/such/sh'])
+        self.assertEqual(self.check('true', '/usr/bin/env no-such-sh'),
+                         ['interpreter not found in PATH: no-such-sh'])
+        with open(self.path('deploy/stages/01-a.update'), 'w') as f:
+            f.write('echo no interpreter line\n')
+        self.assertEqual(n3d.check_script(self.path(
+            'deploy/stages/01-a.update')), ['no #! interpreter line'])
+
+    def test_runs_no_code(self):
+        if n3d.which('perl') is None:
+            self.skipTest('no perl')
+        self.check('BEGIN { open(F, ">", "%s") }'
+                   % self.path('begin'), n3d.which('perl'))
+        self.assertFalse(os.path.exists(self.path('begin')))
+
+
+class FakeConn(object):
+    """Socket taking at most limit bytes per send"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = ''
+        self.error = None
+
+    def send(self, data):
+        if self.error is not None:
+            raise socket.error(self.error, os.strerror(self.error))
+        self.data += data[:self.limit]
+        return len(data[:self.limit])
+
+
+class SubscriberTest(unittest.TestCase):
+
+    def test_drops_oldest_and_reports_them(self):
+        conn = FakeConn(0)
+        subscriber = n3d.Subscriber(conn, 10)
+        for message in ('aaaa', 'bbbb', 'cccc', 'dddd'):
+            subscriber.add(message)
+        self.assertEqual(list(subscriber.messages), ['cccc', 'dddd'])
+        self.assertEqual(subscriber.dropped, 8)
+        self.assertEqual(subscriber.size, 8)
+        conn.limit = 100
+        self.assertTrue(subscriber.send())
+        self.assertEqual(conn.data, 'dropped 8\nccccdddd')
+        self.assertEqual(subscriber.size, 0)
+        self.assertEqual(subscriber.dropped, 0)
+
+    def test_keeps_message_sent_in_part(self):
+        conn = FakeConn(2)
+        subscriber = n3d.Subscriber(conn, 10)
+        subscriber.add('aaaa')
+        conn.error = errno.EAGAIN
+        subscriber.send()
+        conn.error = None
+        self.assertTrue(subscriber.send())
+        self.assertEqual(subscriber.sent, 2)
+        subscriber.add('bbbb')
+        subscriber.add('cccc')
+        self.assertEqual(list(subscriber.messages), ['aaaa', 'cccc'])
+        conn.limit = 100
+        subscriber.send()
+        self.assertEqual(conn.data, 'aaaa' + 'dropped 4\ncccc')
+
+    def test_client_gone(self):
+        conn = FakeConn(100)
+        subscriber = n3d.Subscriber(conn, 10)
+        subscriber.add('aaaa')
+        conn.error = errno.EAGAIN
+        self.assertTrue(subscriber.send())
+        conn.error = errno.EPIPE
+        self.assertFalse(subscriber.send())
+
+
+class OutputBroadcastTest(TempDirTestCase):
+
+    def connect(self):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        conn.connect(self.path('out.sock'))
+        # let the broadcast accept it
+        time.sleep(0.05)
+        return conn
+
+    def test_client_gone_with_messages_queued(self):
+        broadcast = n3d.OutputBroadcast(self.path('out.sock'))
+        for _ in range(5):
+            conn = self.connect()
+            for _ in range(100):
+                broadcast.output('a', 'x' * 5000)
+            conn.close()
+            time.sleep(0.05)
+        self.assertTrue(broadcast.is_alive())
+        conn = self.connect()
+        broadcast.output('a', 'one\n')
+        broadcast.event(dict(event='finish', stage='01-a'))
+        broadcast.close()
+        data = ''
+        for chunk in iter(lambda: conn.recv(4096), ''):
+            data += chunk
+        self.assertEqual(data, 'out 4 a\none\n'
+                         'event {"event": "finish", "stage": "01-a"}\n')
+
+
+class WaitUsageTest(unittest.TestCase):
+
+    def test_usage(self):
+        pid = os.fork()
+        if not pid:
+            os._exit(3)
+        pid_done, status, usage = n3d.wait_usage(pid)
+        self.assertEqual(pid_done, pid)
+        self.assertEqual(n3d.exit_status(status), 3)
+        self.assertTrue(usage['maxrss'] > 0)
+
+    def test_reaped_elsewhere(self):
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(n3d.wait_usage(pid), (pid, None, None))
+        self.assertEqual(n3d.exit_status(None), None)
+
+
+class EnvStoreTest(TempDirTestCase):
+
+    def test_versions_and_snapshots(self):
+        store = n3d.EnvStore(self.path('env.json'), 'r1')
+        store.publish('A', '1', '01-a')
+        store.snapshot('01-a')
+        store.publish('A', '2', '02-b')
+        store.publish('B', 'x')
+        store.snapshot('02-b')
+        self.assertEqual(store.version(), 3)
+        self.assertEqual(store.variables(),
+                         dict(A=('2', '02-b', 2), B=('x', None, 3)))
+        self.assertEqual(store.variables(1), dict(A=('1', '01-a', 1)))
+        self.assertEqual(store.lines('01-a'),
+                         ['A=1 (version 1, set by 01-a)'])
+        self.assertEqual(store.lines('03-c'), None)
+        self.assertEqual(store.drop_stage('02-b'), ['A'])
+        self.assertEqual(store.variables(), dict(B=('x', None, 3)))
+        self.assertEqual(store.lines('02-b'), None)
+        self.assertEqual(store.lines('01-a'),
+                         ['A=1 (version 1, set by 01-a)'])
+
+    def test_persisted_per_run(self):
+        store = n3d.EnvStore(self.path('env.json'), 'r1')
+        store.snapshot('01-a')
+        self.assertEqual(store.data['snapshots'], dict())
+        store.publish('A', '1', '01-a')
+        self.assertEqual(n3d.EnvStore(self.path('env.json'),
+                                      'r1').variables(),
+                         dict(A=('1', '01-a', 1)))
+        self.assertEqual(n3d.EnvStore(self.path('env.json'),
+                                      'r2').variables(), dict())
+
+
+if __name__ == '__main__':
+    unittest.main()